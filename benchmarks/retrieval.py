@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+retrieval - a benchmark of the message retrieval from a.a.m
+
+Copyright (C) 2015 by Felipe Dau <dau.felipe@gmail.com>
+
+Generates a synthetic a.a.m with some articles addressed (by hSubs) to
+known nyms, serves it from a local news server that simulates the
+latency of a connection over Tor and runs aampy against it. Reports
+how fast the articles were checked, how many bytes were transferred
+and whether exactly the messages of the nyms were found:
+
+    python benchmarks/retrieval.py --articles 5000 --latency 0.2
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+For more information, https://github.com/felipedau/nymphemeral
+"""
+import argparse
+import os
+import random
+import shutil
+import socket
+import SocketServer
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from collections import namedtuple
+from email.utils import formatdate
+from Queue import Queue
+from threading import Lock, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nymphemeral import hsub
+from nymphemeral.aampy import AAMpy
+
+
+GROUP = 'alt.anonymous.messages'
+FIRST_ARTICLE = 1000
+CRLF = '\r\n'
+
+Article = namedtuple('Article', ['number', 'message_id', 'subject', 'date',
+                                 'nick', 'lines'])
+
+
+def generate_corpus(articles, hits, passphrases, body_size=2048, seed=0):
+    """Return a list of articles, in which the given number of hits have
+    hSubs of the passphrases and the others have random hSubs
+
+    The articles were posted one per second, up to now
+
+    :param int articles: The number of articles
+    :param int hits: The number of articles addressed to the nyms
+    :param dict passphrases: The hSub passphrases, indexed by nyms
+    :param int body_size: The size of the body of each article, in bytes
+    :param int seed: The seed of the random generator
+    """
+    rand = random.Random(seed)
+    nicks = sorted(passphrases)
+    hit_indexes = set(rand.sample(xrange(articles), min(hits, articles)))
+    posted = time.time() - articles
+    corpus = []
+    for i in xrange(articles):
+        message_id = '<%016x@nymphemeral.invalid>' % rand.getrandbits(64)
+        if i in hit_indexes:
+            nick = rand.choice(nicks)
+            subject = hsub.hash(passphrases[nick])
+        else:
+            nick = None
+            subject = hsub.hash('%x' % rand.getrandbits(64))
+        body = b64encode(''.join(chr(rand.getrandbits(8))
+                                 for _ in xrange(body_size * 3 // 4)))
+        lines = [
+            'From: Nobody <nobody@nymphemeral.invalid>',
+            'Newsgroups: ' + GROUP,
+            'Subject: ' + subject,
+            'Message-ID: ' + message_id,
+            'Date: ' + formatdate(posted + i),
+            '',
+            '-----BEGIN PGP MESSAGE-----',
+            '',
+        ]
+        lines += [body[j:j + 64] for j in xrange(0, len(body), 64)]
+        lines.append('-----END PGP MESSAGE-----')
+        corpus.append(Article(FIRST_ARTICLE + i, message_id, subject,
+                              formatdate(posted + i), nick, lines))
+    return corpus
+
+
+class NewsHandler(SocketServer.StreamRequestHandler):
+    """Handle a connection with the subset of NNTP used by aampy
+
+    Responses are delayed by the latency of the server, but the commands
+    are read as they arrive, so that pipelined commands are not delayed
+    one after the other
+    """
+    def handle(self):
+        news = self.server
+        queue = Queue()
+        sender = Thread(target=self._send_responses, args=(queue,))
+        sender.daemon = True
+        sender.start()
+        queue.put((time.time(), ['200 nymphemeral benchmark server ready']))
+        try:
+            for line in iter(self.rfile.readline, ''):
+                args = line.split()
+                if not args:
+                    continue
+                command = args[0].upper()
+                if command == 'QUIT':
+                    queue.put((time.time(), ['205 closing connection']))
+                    break
+                response = news.respond(command, args[1:])
+                queue.put((time.time() + news.latency, response))
+        finally:
+            queue.put(None)
+            sender.join()
+
+    def _send_responses(self, queue):
+        for item in iter(queue.get, None):
+            due, lines = item
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            data = CRLF.join(lines) + CRLF
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except socket.error:
+                return
+            self.server.count_bytes(len(data))
+
+
+class NewsServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A local news server of a single group, used in place of a.a.m"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, corpus, latency=0.0, overview=True, newnews=True):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), NewsHandler)
+        self.latency = latency
+        self.overview = overview
+        self.newnews = newnews
+        self.bytes_sent = 0
+        self._corpus = corpus
+        self._by_number = dict((a.number, a) for a in corpus)
+        self._by_id = dict((a.message_id, a) for a in corpus)
+        self._lock = Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count_bytes(self, length):
+        with self._lock:
+            self.bytes_sent += length
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def respond(self, command, args):
+        """Return the lines of the response to a command"""
+        if command == 'MODE':
+            return ['200 reader mode']
+        if command == 'GROUP':
+            return ['211 %d %d %d %s' % (len(self._corpus),
+                                         self._corpus[0].number,
+                                         self._corpus[-1].number, GROUP)]
+        if command in ('XOVER', 'OVER') and self.overview:
+            first, sep, last = args[0].partition('-')
+            lines = []
+            for number in xrange(int(first), int(last or first) + 1):
+                a = self._by_number.get(number)
+                if a:
+                    lines.append('\t'.join([
+                        str(a.number), a.subject, a.lines[0], a.date,
+                        a.message_id, '', str(len(CRLF.join(a.lines))),
+                        str(len(a.lines))]))
+            if not lines:
+                # as RFC 3977 servers answer for ranges of deleted articles
+                return ['423 No articles in that range']
+            return ['224 overview follows'] + lines + ['.']
+        if command == 'NEWNEWS' and self.newnews:
+            return (['230 list of new articles follows'] +
+                    [a.message_id for a in self._corpus] + ['.'])
+        if command in ('ARTICLE', 'HEAD', 'BODY'):
+            key = args[0] if args else ''
+            if key.startswith('<'):
+                a = self._by_id.get(key)
+            else:
+                a = self._by_number.get(int(key)) if key.isdigit() else None
+            if a is None:
+                return ['430 no such article']
+            blank = a.lines.index('')
+            if command == 'ARTICLE':
+                code, lines = '220', a.lines
+            elif command == 'HEAD':
+                code, lines = '221', a.lines[:blank]
+            else:
+                code, lines = '222', a.lines[blank + 1:]
+            return (['%s %d %s' % (code, a.number, a.message_id)] +
+                    ['.' + l if l.startswith('.') else l for l in lines] +
+                    ['.'])
+        return ['500 command not recognized']
+
+
+def expected_files(corpus):
+    """Return the names of the files aampy should store for the corpus"""
+    return set('message_' + a.nick + '_' + a.message_id[1:6] + '.txt'
+               for a in corpus if a.nick)
+
+
+def run(args):
+    passphrases = dict(('nym%d@nymphemeral.invalid' % i, 'passphrase%d' % i)
+                       for i in xrange(args.nyms))
+    print 'Generating ' + str(args.articles) + ' articles...'
+    corpus = generate_corpus(args.articles, args.hits, passphrases,
+                             args.body_size, args.seed)
+    if args.gap:
+        # articles in the middle of the group were cancelled or expired
+        middle = (len(corpus) - args.gap) // 2
+        del corpus[middle:middle + args.gap]
+    server = NewsServer(corpus, args.latency, not args.no_overview,
+                        not args.no_newnews)
+    server.start()
+    directory = tempfile.mkdtemp(prefix='nymphemeral-benchmark-')
+    try:
+        aampy = AAMpy(directory, GROUP, '127.0.0.1', server.port,
+                      use_overview=not args.no_overview,
+                      pipeline_depth=args.pipeline_depth,
+                      connections=args.connections,
+                      processes=args.processes)
+        hsubs = dict(passphrases)
+        # every article of the corpus is new
+        hsubs['time'] = time.time() - args.articles - 60
+        aampy.reset()
+        print 'Retrieving messages...'
+        started = time.time()
+        aampy.retrieve_messages(hsubs)
+        elapsed = time.time() - started
+        found = set(os.listdir(directory))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory)
+
+    expected = expected_files(corpus)
+    print
+    print 'Articles:           ' + str(args.articles)
+    print 'Elapsed time:       %.2f s' % elapsed
+    print 'Articles/second:    %.1f' % (args.articles / elapsed)
+    print 'Bytes transferred:  ' + str(server.bytes_sent)
+    print 'Bytes/article:      %.1f' % (float(server.bytes_sent) /
+                                        args.articles)
+    print 'Progress:           ' + str(aampy.progress_ratio)
+    print 'Messages found:     %d of %d' % (len(found & expected),
+                                             len(expected))
+    print 'False hits:         ' + str(len(found - expected))
+    return 0 if found == expected else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the retrieval of messages from a local, '
+                    'synthetic a.a.m')
+    parser.add_argument('--articles', type=int, default=2000,
+                        help='number of articles in the group')
+    parser.add_argument('--hits', type=int, default=20,
+                        help='number of articles addressed to the nyms')
+    parser.add_argument('--nyms', type=int, default=3,
+                        help='number of nyms (hSub passphrases)')
+    parser.add_argument('--body-size', type=int, default=2048,
+                        help='size of the body of each article, in bytes')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='delay of each response, in seconds')
+    parser.add_argument('--pipeline-depth', type=int, default=16)
+    parser.add_argument('--connections', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--no-overview', action='store_true',
+                        help='the server does not support XOVER')
+    parser.add_argument('--no-newnews', action='store_true',
+                        help='the server does not support NEWNEWS')
+    parser.add_argument('--gap', type=int, default=0,
+                        help='number of articles missing in the middle of '
+                             'the group')
+    parser.add_argument('--seed', type=int, default=0)
+    return run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import sys
 
-from .gui import main
+from .cli import main
 
 
 if __name__ == '__main__':
@@ -30,9 +30,11 @@ import os
 import socket
 import time
 from calendar import timegm
-from copy import deepcopy
+from collections import deque, namedtuple
 from email import message_from_string
-from threading import Event
+from email.utils import parsedate_tz
+from Queue import Queue
+from threading import Event, Lock, Thread
 
 from dateutil import parser, tz
 
@@ -40,21 +42,277 @@ from . import hsub
 from . import LINESEP
 
 
+OVERVIEW_CHUNK = 1000
+# articles checked for the date of an article number, doubled while none of
+# them is available
+ARTICLE_DATE_WINDOW = 10
+PIPELINE_DEPTH = 16
+MINIMUM_RANGE_LENGTH = 100
+SPOOL_MAX_AGE = 7 * 86400.0
+
+# kinds of the events published during a retrieval
+STARTED = 'started'
+PROGRESS = 'progress'
+MESSAGE = 'message'
+ERROR = 'error'
+FINISHED = 'finished'
+
+
 log = logging.getLogger(__name__)
 
 
+RetrievalEvent = namedtuple('RetrievalEvent', ['kind', 'data'])
+
+
+def parse_headers(lines, names=('subject', 'date')):
+    """Return the values of some headers of an article, without parsing the
+    whole article
+
+    Only the lines before the first blank one are scanned. Folded headers
+    are unfolded and the first occurrence of each header is kept
+
+    :param lines: The lines of the article (or of its head)
+    :param names: The lower case names of the headers wanted
+    :rtype: dict
+    """
+    headers = {}
+    name = None
+    for line in lines:
+        if not line:
+            break
+        if line[0] in ' \t':
+            if name is not None:
+                headers[name] += line
+            continue
+        name, sep, value = line.partition(':')
+        name = name.strip().lower()
+        if not sep or name not in names or name in headers:
+            name = None
+            continue
+        headers[name] = value
+    return dict((k, v.strip()) for k, v in headers.iteritems())
+
+
+def parse_timestamp(date):
+    """Return the UTC epoch of a date header, or None if it cannot be parsed
+
+    Dates in the RFC 2822 format are parsed directly and dateutil is only
+    used for the ones that are not
+
+    :param str date: The value of a Date header
+    :rtype: float
+    """
+    try:
+        parsed = parsedate_tz(date)
+    except (AttributeError, TypeError, ValueError, IndexError):
+        parsed = None
+    if parsed is not None:
+        try:
+            # dates without a timezone are considered to be in UTC
+            return float(timegm(parsed[:6]) - (parsed[9] or 0))
+        except (TypeError, ValueError, OverflowError):
+            pass
+    try:
+        date = parser.parse(date)
+    except (AttributeError, TypeError, ValueError, OverflowError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=tz.tzutc())
+    return float(timegm(date.astimezone(tz.tzutc()).timetuple()))
+
+
+def fetch_pipelined(server, command, keys, depth=PIPELINE_DEPTH):
+    """Send a HEAD, BODY or ARTICLE command for each key, keeping up to depth
+    commands in flight, and yield the responses in the same order as they
+    stream back
+
+    Yields tuples of (key, message_id, text). Both message_id and text are
+    None when the server does not have the article. Closing the generator
+    before it is exhausted leaves responses pending on the connection,
+    which should not be used anymore
+
+    :param server: The connection to the news server
+    :type server: nntplib.NNTP
+    :param str command: HEAD, BODY or ARTICLE
+    :param keys: Message-IDs or article numbers
+    :param int depth: The maximum number of commands in flight
+    """
+    keys = iter(keys)
+    pending = deque()
+
+    def send_next():
+        for key in keys:
+            server.putcmd(command + ' ' + str(key))
+            pending.append(key)
+            return
+
+    for _ in xrange(max(depth, 1)):
+        send_next()
+    while pending:
+        key = pending.popleft()
+        send_next()
+        try:
+            resp, text = server.getlongresp()
+        except (nntplib.error_temp, nntplib.error_perm, nntplib.error_reply):
+            # no such message (maybe it was deleted?)
+            yield key, None, None
+        else:
+            resp, number, message_id = server.statparse(resp)
+            yield key, message_id, text
+
+
+def fetch_overview(server, first, last):
+    """Return the overview of a range of articles
+
+    Servers answer 423 when none of the articles is available (e.g. they
+    were cancelled or expired), which is an empty overview
+    """
+    try:
+        resp, overviews = server.xover(str(first), str(last))
+    except nntplib.error_temp as e:
+        if not str(e).startswith('423'):
+            raise
+        return []
+    return overviews
+
+
+def hsub_passphrases(hsubs):
+    """Return the hSub passphrases from the hSubs dictionary, without the
+    retrieval state (timestamp and article numbers) stored along with them,
+    whose keys are not email addresses
+
+    :param dict hsubs: The hSubs dictionary
+    :rtype: dict
+    """
+    return dict((k, v) for k, v in hsubs.iteritems() if '@' in k)
+
+
+class Spool(object):
+    """The Message-IDs of the articles already checked, so that they are not
+    downloaded and matched again (when the timestamp is used, or after a
+    retrieval is interrupted)
+
+    The IDs are appended to a file along with the time they were checked,
+    which is compacted when it is loaded by dropping the IDs older than
+    max_age seconds
+    """
+    def __init__(self, path, max_age=SPOOL_MAX_AGE):
+        self._path = path
+        self._max_age = max_age
+        self._ids = {}
+        self._file = None
+        self._lock = Lock()
+
+    def __contains__(self, message_id):
+        return message_id in self._ids
+
+    def open(self):
+        """Load the IDs that did not expire and open the file to append new
+        ones"""
+        oldest = time.time() - self._max_age
+        self._ids = {}
+        expired = False
+        try:
+            with open(self._path, 'r') as f:
+                for line in f:
+                    try:
+                        checked, message_id = line.split()
+                        checked = float(checked)
+                    except ValueError:
+                        expired = True
+                        continue
+                    if checked < oldest:
+                        expired = True
+                    else:
+                        self._ids[message_id] = checked
+        except IOError:
+            pass
+        try:
+            if expired:
+                temp_path = self._path + '.tmp'
+                with open(temp_path, 'w') as f:
+                    for message_id, checked in self._ids.iteritems():
+                        f.write(repr(checked) + ' ' + message_id + LINESEP)
+                os.rename(temp_path, self._path)
+                log.debug(str(len(self._ids)) + ' Message-IDs kept in the '
+                          'spool')
+            self._file = open(self._path, 'a')
+        except (IOError, OSError):
+            log.error('IOError while writing to ' + self._path)
+            self._file = None
+
+    def add(self, message_ids):
+        """Store the IDs of articles that were checked"""
+        checked = time.time()
+        lines = []
+        with self._lock:
+            for message_id in message_ids:
+                if message_id and message_id not in self._ids:
+                    self._ids[message_id] = checked
+                    lines.append(repr(checked) + ' ' + message_id + LINESEP)
+            if lines and self._file:
+                try:
+                    self._file.write(''.join(lines))
+                    self._file.flush()
+                except IOError:
+                    log.error('IOError while writing to ' + self._path)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class ArticleRange(object):
+    """The progress of a range of articles being checked. Ranges of articles
+    listed by NEWNEWS have no article numbers, only their total"""
+    def __init__(self, start=None, last=None, total=None):
+        self.start = start
+        self.last = last
+        if total is None:
+            total = last - start + 1
+        self.total = total
+        self.checked = 0
+        self.article_number = None
+        self.timestamp = None
+
+    @property
+    def completed(self):
+        return self.checked >= self.total
+
+    def update(self, checked, article_number=None, timestamp=None):
+        self.checked += checked
+        if article_number is not None:
+            self.article_number = article_number
+        if timestamp is not None:
+            self.timestamp = timestamp
+
+
 class AAMpy(object):
-    def __init__(self, directory, group, server, port):
+    def __init__(self, directory, group, server, port, use_overview=True,
+                 pipeline_depth=PIPELINE_DEPTH, connections=1, processes=1,
+                 spool=None):
         self._directory = directory
         self._group = group
         self._server = server
         self._port = port
+        self._use_overview = use_overview
+        self._pipeline_depth = pipeline_depth
+        self._connections = connections
+        self._processes = processes
+        self._spool = spool
 
         self._event = None
         self._is_running = None
         self._server_found = None
         self._timestamp = None
+        self._article_number = None
         self._progress_ratio = None
+        self._ranges = []
+        self._lock = Lock()
+        # connections to the news server that are currently open
+        self._open_servers = set()
+        self._listeners = []
 
         log.debug('Initialized')
 
@@ -74,95 +332,469 @@ class AAMpy(object):
     def timestamp(self):
         return self._timestamp
 
+    @property
+    def article_number(self):
+        return self._article_number
+
+    @property
+    def article_key(self):
+        """The key of the last article number checked in the hSubs dictionary,
+        specific to the news server and group"""
+        return ':'.join(['article', self._server, str(self._port),
+                         self._group])
+
     @property
     def progress_ratio(self):
         return self._progress_ratio
 
+    def add_listener(self, listener):
+        """Call the listener with a RetrievalEvent whenever the retrieval
+        starts, makes progress, stores a message or finishes
+
+        Listeners are called from the threads of the retrieval, so they
+        should return quickly and not touch the GUI directly
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        try:
+            self._listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def subscribe(self):
+        """Return a queue that receives every RetrievalEvent published until
+        unsubscribe() is called with it
+
+        The queue can be drained (with get_nowait()) by a thread that cannot
+        be called by the threads of the retrieval, such as the GUI's
+        """
+        queue = Queue()
+        self.add_listener(queue.put)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.remove_listener(queue.put)
+
+    def _publish(self, kind, **data):
+        event = RetrievalEvent(kind, data)
+        for listener in list(self._listeners):
+            try:
+                listener(event)
+            except Exception:
+                log.exception('Listener failed to handle a ' + kind +
+                              ' event')
+
+    def _connect(self):
+        """Open a connection to the news server that is closed by stop()"""
+        server = nntplib.NNTP(self._server, self._port)
+        with self._lock:
+            self._open_servers.add(server)
+        if self._event.is_set():
+            self._disconnect(server)
+            raise EOFError('The retrieval was stopped')
+        return server
+
+    def _disconnect(self, server):
+        with self._lock:
+            self._open_servers.discard(server)
+        try:
+            if self._event.is_set():
+                server.sock.close()
+                server.file.close()
+            else:
+                server.quit()
+        except (socket.error, EOFError, AttributeError, nntplib.NNTPError):
+            pass
+
+    def _interrupt_connections(self):
+        """Shut the open connections down, so that any thread blocked on them
+        fails right away instead of waiting for the news server"""
+        with self._lock:
+            servers = list(self._open_servers)
+        for server in servers:
+            try:
+                server.sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, AttributeError):
+                pass
+
+    def _save_message(self, nick, message_id, text):
+        """Write an article that matched a nickname to the directory"""
+        log.info('Found a message for nickname ' + nick)
+        message = message_from_string(LINESEP.join(text))
+        file_name = 'message_' + nick + '_' + message_id[1:6] + '.txt'
+        file_path = os.path.join(self._directory, file_name)
+        # written under another name and then renamed, so that the client
+        # never reads a message that is still being written
+        with open(file_path + '.tmp', 'w') as f:
+            f.write(message.as_string() + LINESEP)
+        os.rename(file_path + '.tmp', file_path)
+        log.info('Encrypted message stored in ' + file_name)
+        self._publish(MESSAGE, nick=nick, file_name=file_name)
+
+    def _merge_progress(self):
+        """Merge the progress of the ranges being checked
+
+        The article number (and its timestamp) only advances through ranges
+        that were completely checked, so that no article is skipped by the
+        next retrieval if this one is interrupted
+        """
+        with self._lock:
+            checked = sum(r.checked for r in self._ranges)
+            total = sum(r.total for r in self._ranges)
+            if total:
+                self._progress_ratio = float(checked) / float(total)
+            for r in self._ranges:
+                if r.timestamp is not None:
+                    self._timestamp = r.timestamp
+                if r.article_number is not None:
+                    self._article_number = r.article_number
+                if not r.completed:
+                    break
+            ratio = self._progress_ratio
+        self._publish(PROGRESS, checked=checked, total=total, ratio=ratio)
+
+    def _article_date(self, server, number, last):
+        """Return the date of the first available article from the number,
+        or None if there is none up to the last one
+
+        Deleted articles have no overview nor headers, so a small window of
+        articles is checked, moving on to the next (larger) windows while
+        none of them is available
+        """
+        window = ARTICLE_DATE_WINDOW
+        while number <= last:
+            end = min(number + window - 1, last)
+            if self._use_overview:
+                dates = [overview[3]
+                         for overview in fetch_overview(server, number, end)]
+            else:
+                dates = []
+                responses = fetch_pipelined(server, 'HEAD',
+                                            xrange(number, end + 1),
+                                            self._pipeline_depth)
+                for key, message_id, text in responses:
+                    if text is not None:
+                        dates.append(parse_headers(text,
+                                                   ('date',)).get('date'))
+            for date in dates:
+                date = parse_timestamp(date)
+                if date is not None:
+                    return date
+            number = end + 1
+            window = min(window * 2, OVERVIEW_CHUNK)
+        return None
+
+    def _first_article_since(self, server, first, last, timestamp):
+        """Return the number of the first article posted after the timestamp
+
+        A binary search is done on the article numbers, as a.a.m articles are
+        stored in (roughly) chronological order
+        """
+        low, high = first, last + 1
+        while low < high:
+            middle = (low + high) // 2
+            date = self._article_date(server, middle, last)
+            if date is None or date < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _download_hits(self, server, matches, message_ids, article_range,
+                       end, timestamp):
+        """Download the articles that matched in a chunk of overviews"""
+        # nicknames indexed by the Message-IDs of the articles that matched
+        hits = {}
+        for message_id, nick in matches.get():
+            hits.setdefault(message_id, []).append(nick)
+        responses = fetch_pipelined(server, 'ARTICLE', hits.keys(),
+                                    self._pipeline_depth)
+        for key, message_id, text in responses:
+            if self._event.is_set():
+                return False
+            if text is not None:
+                for nick in hits[key]:
+                    self._save_message(nick, message_id, text)
+        # the chunk is only considered checked after its hits are stored
+        if self._spool is not None:
+            self._spool.add(message_ids)
+        article_range.update(end - article_range.start + 1 -
+                             article_range.checked, end, timestamp)
+        self._merge_progress()
+        return True
+
+    def _scan_overview(self, server, matcher, article_range):
+        """Match the hSubs against the overview of the range of articles and
+        download only the articles that match
+
+        The subjects of a chunk are matched (possibly by other processes)
+        while the overview of the next chunk is downloaded
+
+        Raises nntplib.error_perm if the server does not support XOVER
+        """
+        start, last = article_range.start, article_range.last
+        pending = None
+        for chunk in xrange(start + article_range.checked, last + 1,
+                            OVERVIEW_CHUNK):
+            if self._event.is_set():
+                return False
+            end = min(chunk + OVERVIEW_CHUNK - 1, last)
+            overviews = fetch_overview(server, chunk, end)
+            timestamp = None
+            for overview in reversed(overviews):
+                timestamp = parse_timestamp(overview[3])
+                if timestamp is not None:
+                    break
+            if self._spool is not None:
+                overviews = [overview for overview in overviews
+                             if overview[4] not in self._spool]
+            message_ids = [overview[4] for overview in overviews]
+            matches = matcher.match_async((overview[4], overview[1])
+                                          for overview in overviews)
+            if pending and not self._download_hits(server, *pending):
+                return False
+            pending = (matches, message_ids, article_range, end, timestamp)
+        if pending:
+            return self._download_hits(server, *pending)
+        return True
+
+    def _scan_responses(self, matcher, responses, article_range):
+        """Match the hSubs against the subjects of the articles downloaded
+
+        If the responses are keyed by article numbers, the number of the last
+        article checked is kept
+        """
+        numbered = article_range.start is not None
+        for key, message_id, text in responses:
+            if self._event.is_set():
+                return False
+            timestamp = None
+            if text is not None:
+                # the article is only parsed as a whole if it matches
+                headers = parse_headers(text)
+                for nick in matcher.match_subject(headers.get('subject')):
+                    self._save_message(nick, message_id, text)
+                timestamp = parse_timestamp(headers.get('date'))
+                if self._spool is not None:
+                    self._spool.add([message_id])
+            article_range.update(1, key if numbered else None, timestamp)
+            self._merge_progress()
+        return True
+
+    def _scan_range(self, server, matcher, article_range):
+        """Check a range of articles, using their overviews if possible"""
+        if self._use_overview:
+            try:
+                return self._scan_overview(server, matcher, article_range)
+            except (nntplib.error_perm, nntplib.error_reply):
+                log.info('The news server does not support overviews. '
+                         'Downloading every article instead')
+                self._use_overview = False
+        numbers = xrange(article_range.start + article_range.checked,
+                         article_range.last + 1)
+        responses = fetch_pipelined(server, 'ARTICLE', numbers,
+                                    self._pipeline_depth)
+        return self._scan_responses(matcher, responses, article_range)
+
+    def _scan_range_with_new_connection(self, matcher, article_range):
+        """Open another connection to the news server to check a range of
+        articles. Used by the workers of the connection pool"""
+        try:
+            server = self._connect()
+        except (socket.error, EOFError, nntplib.NNTPError) as e:
+            if not self._event.is_set():
+                log.warn('Articles ' + str(article_range.start) + '-' +
+                         str(article_range.last) + ' could not be checked: ' +
+                         str(e))
+                self._publish(ERROR, error=str(e))
+            return
+        try:
+            server.group(self._group)
+            self._scan_range(server, matcher, article_range)
+        except (socket.error, EOFError, nntplib.NNTPError) as e:
+            if not self._event.is_set():
+                log.warn('Articles ' + str(article_range.start) + '-' +
+                         str(article_range.last) + ' could not be checked: ' +
+                         str(e))
+                self._publish(ERROR, error=str(e))
+        finally:
+            self._disconnect(server)
+
+    def _scan_ranges(self, server, matcher, start, last):
+        """Split the articles in ranges to be checked in parallel by the
+        connection pool. The first range is checked with the connection
+        given"""
+        total = last - start + 1
+        if total <= 0:
+            # there are no new articles
+            self._ranges = []
+            return True
+        connections = max(1, min(self._connections,
+                                 total // MINIMUM_RANGE_LENGTH))
+        length = -(-total // connections)
+        self._ranges = [ArticleRange(s, min(s + length - 1, last))
+                        for s in xrange(start, last + 1, length)]
+
+        workers = []
+        for article_range in self._ranges[1:]:
+            worker = Thread(target=self._scan_range_with_new_connection,
+                            args=(matcher, article_range))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        self._scan_range(server, matcher, self._ranges[0])
+        for worker in workers:
+            worker.join()
+        return all(r.completed for r in self._ranges)
+
+    def _scan_new_articles(self, server, matcher, timestamp):
+        """Download every article posted after the timestamp (listed by
+        NEWNEWS) and match the hSubs against their subjects
+
+        Raises nntplib.error_perm if the server does not support NEWNEWS
+        """
+        YYMMDD = time.strftime('%y%m%d', time.gmtime(timestamp))
+        HHMMSS = time.strftime('%H%M%S', time.gmtime(timestamp))
+
+        response, articles = server.newnews(self._group, YYMMDD, HHMMSS)
+        if self._spool is not None:
+            articles = [a for a in articles if a not in self._spool]
+        self._ranges = [ArticleRange(total=len(articles))]
+        responses = fetch_pipelined(server, 'ARTICLE', articles,
+                                    self._pipeline_depth)
+        return self._scan_responses(matcher, responses, self._ranges[0])
+
     def reset(self):
         self._event = Event()
         self._is_running = None
         self._server_found = None
         self._timestamp = None
+        self._article_number = None
         self._progress_ratio = None
 
     def stop(self):
+        """Stop the retrieval. Connections are shut down, so that it stops
+        promptly even if the news server is slow to respond"""
         self._is_running = False
         self._event.set()
+        self._interrupt_connections()
 
     def retrieve_messages(self, hsubs):
         self._server_found = False
         self._timestamp = None
+        self._article_number = None
         self._progress_ratio = None
+        self._ranges = []
         self._is_running = True
 
         try:
-            server = nntplib.NNTP(self._server, self._port)
-        except socket.error:
-            log.warn('The news server cannot be found')
-            self.stop()
+            server = self._connect()
+        except (socket.error, EOFError, nntplib.NNTPError) as e:
+            if not self._event.is_set():
+                log.warn('The news server cannot be found')
+                self._publish(ERROR, error=str(e))
+                self.stop()
+            self._publish(FINISHED, completed=False, server_found=False)
             return
         else:
             self._server_found = True
+        self._publish(STARTED, server=self._server, group=self._group)
 
-        temp_hsubs = deepcopy(hsubs)
+        if self._processes > 1:
+            matcher = hsub.HsubPool(hsub_passphrases(hsubs), self._processes)
+        else:
+            matcher = hsub.HsubMatcher(hsub_passphrases(hsubs))
+        if self._spool is not None:
+            self._spool.open()
         try:
-            timestamp = float(temp_hsubs['time'])
+            completed = self._retrieve_with_matcher(server, matcher, hsubs)
+        except (socket.error, EOFError, nntplib.NNTPError) as e:
+            completed = False
+            if not self._event.is_set():
+                log.warn('Message retrieval failed: ' + str(e))
+                self._publish(ERROR, error=str(e))
+                self.stop()
+        finally:
+            matcher.close()
+            if self._spool is not None:
+                self._spool.close()
+            self._disconnect(server)
+
+        if completed:
+            log.info('Message retrieval is done')
+        else:
+            log.info('Message retrieval was interrupted')
+        # the retrieval is over even if a range could not be checked, which
+        # does not stop it
+        self._is_running = False
+        self._event.set()
+        # published after is_running is updated
+        self._publish(FINISHED, completed=completed, server_found=True)
+
+    def _retrieve_with_matcher(self, server, matcher, hsubs):
+        """Check the new articles since the last retrieval. Return whether
+        every article was checked"""
+        try:
+            timestamp = float(hsubs['time'])
         except KeyError:
             timestamp = time.time() - 3600.0
             log.info('Timestamp not found. Set to the last hour')
-        else:
-            del temp_hsubs['time']
-
-        YYMMDD = time.strftime('%y%m%d', time.gmtime(timestamp))
-        HHMMSS = time.strftime('%H%M%S', time.gmtime(timestamp))
+        try:
+            article_number = int(hsubs[self.article_key])
+        except KeyError:
+            article_number = None
 
-        log.info('Retrieving new messages since ' +
-                 time.strftime('%Y-%m-%d %H:%M:%S %z', time.gmtime(timestamp)))
+        try:
+            resp, count, first, last, name = server.group(self._group)
+        except (nntplib.error_temp, nntplib.error_perm, nntplib.error_reply):
+            log.info('The news group cannot be selected. Article numbers '
+                     'will not be used')
+            first = last = None
+        else:
+            first, last = int(first), int(last)
 
-        # download messages
-        response, articles = server.newnews(self._group, YYMMDD, HHMMSS)
-        total_messages = len(articles)
-        messages_checked = 0
-        self._progress_ratio = 0
+        start = None
+        if last is not None:
+            if article_number is not None and article_number <= last:
+                # articles that expired since the last retrieval are skipped
+                start = max(article_number + 1, first)
+                log.info('Retrieving new messages since article ' +
+                         str(article_number))
+            elif not self._use_overview:
+                # NEWNEWS is preferred to a binary search with HEAD
+                start = None
+            else:
+                try:
+                    start = self._first_article_since(server, first, last,
+                                                      timestamp)
+                except (nntplib.error_perm, nntplib.error_reply):
+                    log.info('The news server does not support overviews')
+                    self._use_overview = False
 
-        for msg_id in articles:
-            if self._event.is_set():
-                log.info('Message retrieval was interrupted')
-                return
+        if start is None:
+            log.info('Retrieving new messages since ' +
+                     time.strftime('%Y-%m-%d %H:%M:%S %z',
+                                   time.gmtime(timestamp)))
             try:
-                resp, id, message_id, text = server.article(msg_id)
-            except (nntplib.error_temp, nntplib.error_perm):
-                # no such message (maybe it was deleted?)
-                pass
+                completed = self._scan_new_articles(server, matcher,
+                                                    timestamp)
+            except (nntplib.error_perm, nntplib.error_reply):
+                if last is None:
+                    raise
+                log.info('The news server does not support NEWNEWS. '
+                         'Searching the article numbers instead')
+                start = self._first_article_since(server, first, last,
+                                                  timestamp)
             else:
-                message = message_from_string(LINESEP.join(text))
-                subject = message.get('Subject')
-                if subject:
-                    subject_length = len(subject)
-                    if hsub.MINIMUM_LENGTH <= subject_length <= hsub.MAXIMUM_LENGTH:
-                        iv = hsub.hexiv(subject)
-                        if iv:
-                            for nick, passphrase in temp_hsubs.items():
-                                # if match: write message to file
-                                if hsub.hash(passphrase, iv, subject_length) == subject:
-                                    log.info('Found a message for nickname ' +
-                                             nick)
-                                    file_name = 'message_' + nick + '_' + message_id[1:6] + '.txt'
-                                    file_path = os.path.join(
-                                        self._directory, file_name
-                                    )
-                                    with open(file_path, 'w') as f:
-                                        f.write(message.as_string() + LINESEP)
-                                        log.info('Encrypted message stored in '
-                                                 + file_name)
-                date = parser.parse(message.get('Date'))
-                if date:
-                    self._timestamp = float(timegm(date.astimezone(tz.tzutc()).timetuple()))
-                messages_checked += 1
-                self._progress_ratio = float(messages_checked) / float(total_messages)
-
-        if self._timestamp == timestamp:
-            self._timestamp = None
-
-        log.info('Message retrieval is done')
-        self.stop()
+                if completed and last is not None:
+                    self._article_number = last
+        if start is not None:
+            completed = self._scan_ranges(server, matcher, start, last)
+
+        if completed:
+            if self._timestamp == timestamp:
+                self._timestamp = None
+            if self._article_number == article_number:
+                self._article_number = None
+        return completed
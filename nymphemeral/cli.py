@@ -0,0 +1,137 @@
+import argparse
+import getpass
+import signal
+import sys
+import time
+from threading import Event
+
+from . import errors
+
+
+# exit statuses of the fetch command
+EXIT_SUCCESS = 0
+EXIT_RETRIEVAL_FAILED = 1
+EXIT_LOGIN_FAILED = 2
+
+# seconds between the retrievals of the daemon
+DEFAULT_INTERVAL = 900
+
+
+def interval(value):
+    """Parse the seconds between the retrievals of the daemon"""
+    seconds = float(value)
+    if seconds < 1:
+        raise argparse.ArgumentTypeError('must be at least 1 second')
+    return seconds
+
+
+def read_passphrase(args):
+    if args.passphrase_file:
+        with open(args.passphrase_file) as f:
+            return f.readline().rstrip('\r\n')
+    return getpass.getpass('Passphrase of ' + args.nym + ': ')
+
+
+def retrieve(client):
+    """Retrieve the new messages once. Return the exit status"""
+    started = time.time()
+    completed, found = client.retrieve_messages()
+    if not client.aampy.server_found:
+        print 'The news server cannot be found'
+        return EXIT_RETRIEVAL_FAILED
+    for nym, count in sorted(found.items()):
+        print str(count) + ' new message(s) for ' + nym
+    print ('Retrieval ' + ('completed' if completed else 'interrupted') +
+           ' in %.1f s, %d new message(s)' % (time.time() - started,
+                                              sum(found.values())))
+    if not completed:
+        return EXIT_RETRIEVAL_FAILED
+    return EXIT_SUCCESS
+
+
+def fetch(args):
+    """Log in with the nym and retrieve its messages (and the ones of the
+    nyms whose hSub passphrases it can read) once or periodically
+
+    The session (with the conversation state and the GPG instance) is kept
+    between the retrievals of the daemon
+    """
+    # imported here, so that the arguments are parsed before the client
+    # creates its files
+    from .client import Client
+    from .nym import Nym
+
+    client = Client()
+    try:
+        nym = Nym(args.nym, read_passphrase(args))
+        if not nym.passphrase:
+            raise errors.InvalidPassphraseError()
+        client.start_session(nym, client.use_agent, client.output_method)
+    except errors.NymphemeralError as e:
+        print >> sys.stderr, e.title + ': ' + e.message
+        client.close()
+        return EXIT_LOGIN_FAILED
+    except KeyError:
+        # the nym has no hSub passphrase to read its messages with
+        print >> sys.stderr, 'hSub passphrase of ' + args.nym + ' not found'
+        client.close()
+        return EXIT_LOGIN_FAILED
+
+    stopped = Event()
+
+    def stop(signum, frame):
+        stopped.set()
+        if client.aampy.is_running:
+            client.stop_aampy()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    status = EXIT_SUCCESS
+    try:
+        while True:
+            cycle_status = retrieve(client)
+            # the daemon exits with the status of the last retrieval that
+            # was not interrupted by its termination
+            if not (args.daemon and stopped.is_set()):
+                status = cycle_status
+            if not args.daemon:
+                break
+            # Event.wait() without a timeout would not return on signals
+            deadline = time.time() + args.interval
+            while not stopped.is_set() and time.time() < deadline:
+                stopped.wait(min(1.0, deadline - time.time()))
+            if stopped.is_set():
+                break
+    finally:
+        client.end_session()
+        client.close()
+    return status
+
+
+def main(argv=None):
+    """Run the GUI or, with the fetch command, retrieve messages without it"""
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] != 'fetch':
+        from .gui import main as gui_main
+        return gui_main()
+
+    parser = argparse.ArgumentParser(
+        prog='nymphemeral fetch',
+        description='Retrieve the messages of the nyms from the news group '
+                    'into the message store, without the GUI')
+    parser.add_argument('--nym', required=True,
+                        help='address of the nym used to log in')
+    parser.add_argument('--passphrase-file',
+                        help='file with the passphrase of the nym in its '
+                             'first line (prompted for by default)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--once', action='store_true',
+                      help='retrieve the messages once and exit (default)')
+    mode.add_argument('--daemon', action='store_true',
+                      help='retrieve the messages periodically until '
+                           'terminated')
+    parser.add_argument('--interval', type=interval, default=DEFAULT_INTERVAL,
+                        help='seconds between the retrievals of the daemon '
+                             '(default: %(default)s)')
+    return fetch(parser.parse_args(argv[1:]))
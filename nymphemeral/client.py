@@ -1,28 +1,38 @@
 import ConfigParser
 import hashlib
+import hmac
+import json
 import logging
 import os
 import re
+import sqlite3
 import subprocess
 import sys
 import time
-from binascii import a2b_base64, b2a_base64, hexlify
+from binascii import a2b_base64, b2a_base64, hexlify, Error as BinasciiError
 from email import message_from_string
-from threading import Thread
-from Tkinter import Tk
+from multiprocessing.pool import ThreadPool
+from threading import Lock, Thread
 
 import gnupg
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
 from Crypto.Random.random import getrandbits
+from Crypto.Util import Counter
 from Crypto.Util.number import long_to_bytes
+from passlib.utils.pbkdf2 import pbkdf2
 from pyaxo import Axolotl
 
 from . import errors
 from . import LINESEP, logger, PATHSEP
-from .aampy import AAMpy
-from .keyring import read_default_keys
+from .aampy import (AAMpy, FINISHED, hsub_passphrases, MESSAGE,
+                    parse_headers, parse_timestamp, Spool)
+from .jobs import JobExecutor
+from .keyring import KeyringIndex, read_default_keys
 from .message import Message
 from .nym import Nym
 from .session import Session
+from .store import MessageStore, NEWEST_FIRST, OLDEST_FIRST, sort_key
 
 
 USER_PATH = os.path.expanduser('~')
@@ -55,9 +65,42 @@ MIX_CONFIGS = [
 
 RANDOM_KEY_BYTE_LENGTH = 32
 
+# number of messages read from the message store at a time
+MESSAGES_PAGE_SIZE = 100
+
+ENVELOPE_KEY_ITERATIONS = 100000
+ENVELOPE_NONCE_LENGTH = 16
+ENVELOPE_MAC_LENGTH = 32
+
+# skipped message keys of the conversation state (to decrypt messages
+# received out of order) are kept for two days, up to a limit
+SKIPPED_KEYS_LIFETIME = 2 * 86400
+SKIPPED_KEYS_LIMIT = 2000
+
+SKIPPED_KEYS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS skipped_keys (
+    my_identity TEXT,
+    other_identity TEXT,
+    header_key BLOB,
+    number INTEGER,
+    message_key BLOB,
+    timestamp INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS skipped_keys_header_number
+    ON skipped_keys (header_key, number);
+"""
+
+# OpenPGP packet tags
+PUBKEY_ENC_PACKET = 1
+SYMKEY_ENC_PACKET = 3
+
 
 log = logging.getLogger(__name__)
 
+# GPG instances created by new_gpg(), indexed by their arguments
+_gpg_instances = {}
+_gpg_instances_lock = Lock()
+
 
 def add_to_head(element, elements):
     """Add an element to the head of a list, removing duplicates of it"""
@@ -151,6 +194,21 @@ def save_data(data, identifier):
 
 
 def new_gpg(home, use_agent=False, throw_keyids=False):
+    """Return a GPG instance for the home directory and options
+
+    Creating an instance calls gpg to check its version, so instances are
+    reused by later calls with the same arguments
+    """
+    key = (home, use_agent, throw_keyids)
+    with _gpg_instances_lock:
+        try:
+            return _gpg_instances[key]
+        except KeyError:
+            gpg = _gpg_instances[key] = _create_gpg(*key)
+            return gpg
+
+
+def _create_gpg(home, use_agent, throw_keyids):
     binary = '/usr/bin/gpg'
 
     options = ['--personal-digest-preferences=sha256',
@@ -181,13 +239,14 @@ def generate_key(gpg, name, address, passphrase, duration):
     return gpg.export_keys(keyids=address), fingerprint
 
 
-def retrieve_key(gpg, search_query):
+def retrieve_key(keyring, search_query):
     """Retrieve a key with user IDs that match the search query. Returns a
     dictionary of the key if it is the only one found, raising errors
     otherwise
 
-    :param gpg: The object that might have the data being searched
-    :type gpg: gnupg.GPG
+    :param keyring: The index of the keyring that might have the data being
+        searched
+    :type keyring: keyring.KeyringIndex
     :param str search_query: The search query
     :rtype: dict
     """
@@ -195,45 +254,27 @@ def retrieve_key(gpg, search_query):
         search_query = search_query.lower()
     except AttributeError:
         raise errors.InvalidSearchQueryError()
-    else:
-        def matches(info):
-            return info.lower().endswith(search_query)
-        results = []
-        keys = gpg.list_keys()
-
-        for k in keys:
-            if matches(k['keyid']) or matches(k['fingerprint']):
-                results.append(k)
-            else:
-                for sub in k['subkeys']:
-                    if matches(sub[0]):
-                        results.append(k)
-                        break
-                else:
-                    for uid in k['uids']:
-                        if re.search(r'\b' + search_query + r'\b', uid,
-                                     flags=re.IGNORECASE):
-                            results.append(k)
-                            break
-        if results:
-            for r in results[1:]:
-                if r['fingerprint'] != results[0]['fingerprint']:
-                    raise errors.AmbiguousUidError(search_query)
-            else:
-                return results[0]
+    results = keyring.search(search_query)
+    if results:
+        for r in results[1:]:
+            if r['fingerprint'] != results[0]['fingerprint']:
+                raise errors.AmbiguousUidError(search_query)
         else:
-            raise errors.KeyNotFoundError(search_query)
+            return results[0]
+    else:
+        raise errors.KeyNotFoundError(search_query)
 
 
-def retrieve_fingerprint(gpg, search_query):
+def retrieve_fingerprint(keyring, search_query):
     """Find the ONLY fingerprint in the keyring for the search query
 
-    :param gpg: The object that might have the data being searched
-    :type gpg: gnupg.GPG
+    :param keyring: The index of the keyring that might have the data being
+        searched
+    :type keyring: keyring.KeyringIndex
     :param str search_query: The search query
     :rtype: str
     """
-    return retrieve_key(gpg, search_query)['fingerprint']
+    return retrieve_key(keyring, search_query)['fingerprint']
 
 
 def format_key_info(key):
@@ -261,10 +302,101 @@ def format_key_info(key):
     return LINESEP.join(key['uids'] + [', '.join(details)] + [''])
 
 
+def read_packets(data):
+    """Yield the tag and the body of each OpenPGP packet of the data until
+    one with an indeterminate or partial length, which can only be a data
+    packet (and the last one we are interested in)
+
+    Raises ValueError if the data is not a sequence of packets
+    """
+    position = 0
+    while position < len(data):
+        header = ord(data[position])
+        if not header & 0x80:
+            raise ValueError('Invalid packet header')
+        if header & 0x40:
+            # new format
+            tag = header & 0x3f
+            first = ord(data[position + 1])
+            if first < 192:
+                length, position = first, position + 2
+            elif first < 224:
+                length = ((first - 192) << 8) + ord(data[position + 2]) + 192
+                position += 3
+            elif first == 255:
+                length = int(hexlify(data[position + 2:position + 6]), 16)
+                position += 6
+            else:
+                yield tag, None
+                return
+        else:
+            # old format
+            tag = (header >> 2) & 0x0f
+            length_type = header & 0x03
+            if length_type == 3:
+                yield tag, None
+                return
+            size = 1 << length_type
+            length = int(hexlify(data[position + 1:position + 1 + size]), 16)
+            position += 1 + size
+        if position + length > len(data):
+            raise ValueError('Truncated packet')
+        yield tag, data[position:position + length]
+        position += length
+
+
+def dearmor(data):
+    """Return the binary data of the first PGP message armored in the data,
+    or None if there is not one"""
+    block = search_pgp_message(data)
+    if not block:
+        return None
+    lines = block.splitlines()[1:-1]
+    # skip the armor headers, which end with a blank line
+    try:
+        lines = lines[lines.index('') + 1:]
+    except ValueError:
+        pass
+    # the checksum is the line that starts with "="
+    body = ''.join(l.strip() for l in lines if not l.startswith('='))
+    try:
+        return a2b_base64(body)
+    except BinasciiError:
+        return None
+
+
 def retrieve_keyids(msg):
     """
     Return key IDs used to encrypt a PGP message
 
+    The IDs are read from the public-key encrypted session key packets that
+    precede the encrypted data, without calling gpg. If the message cannot
+    be read, gpg is used instead
+    """
+    data = dearmor(msg)
+    if data is None:
+        data = msg
+    keyids = []
+    try:
+        for tag, body in read_packets(data):
+            if tag == PUBKEY_ENC_PACKET:
+                keyid = hexlify(body[1:9]).upper()
+                if len(keyid) != 16:
+                    raise ValueError('Invalid key ID')
+                # append valid key IDs (not thrown away)
+                if not re.match('^0*$', keyid):
+                    keyids.append(keyid)
+            elif tag != SYMKEY_ENC_PACKET:
+                break
+    except (ValueError, IndexError, TypeError):
+        return _retrieve_keyids_with_gpg(msg)
+    return keyids
+
+
+def _retrieve_keyids_with_gpg(msg):
+    """
+    Return key IDs used to encrypt a PGP message
+
     Expects to get something like the following format from gpg --list-packets:
         :pubkey enc packet: version 3, algo 1, keyid 4096409640964096
             data: [4096 bits]
@@ -313,14 +445,6 @@ def decrypt_data(gpg, data, passphrase):
         return None
 
 
-def copy_to_clipboard(data):
-    t = Tk()
-    t.withdraw()
-    t.clipboard_clear()
-    t.clipboard_append(data)
-    t.destroy()
-
-
 def create_axolotl(nym, directory):
     # workaround to suppress prints by pyaxo
     sys.stdout = open(os.devnull, 'w')
@@ -337,8 +461,9 @@ def create_axolotl(nym, directory):
 
 
 def create_state(axolotl, other_name, mkey):
-    if os.path.exists(axolotl.dbname):
-        os.unlink(axolotl.dbname)
+    for path in [axolotl.dbname, journal_path(axolotl.dbname)]:
+        if os.path.exists(path):
+            os.unlink(path)
     # Based on the latest protocol specification (Oct/2014), Alice is
     # the one that starts ratcheting the keys. Therefore, she needs
     # Bob's Diffie-Hellman Ratchet Key (DHR). Since the nym already
@@ -362,17 +487,429 @@ def get_random_key(byte_length=RANDOM_KEY_BYTE_LENGTH):
     return hexlify(long_to_bytes(getrandbits(byte_length << 3)))
 
 
+def _derive_key(nym, purpose):
+    """Return the keys (for encryption and authentication) used by the nym
+    for a purpose, derived from its passphrase
+
+    :param nym: A nym with fingerprint and passhrase attributes
+    :type nym: nym.Nym
+    :param str purpose: Salts the derivation, so that each purpose has its
+        own keys
+    :rtype: tuple
+    """
+    key = hashlib.pbkdf2_hmac('sha256', nym.passphrase,
+                              'nymphemeral ' + purpose + ' ' + nym.fingerprint,
+                              ENVELOPE_KEY_ITERATIONS, 64)
+    return key[:32], key[32:]
+
+
+def derive_envelope_key(nym):
+    """Return the keys of the envelopes of the nym's messages"""
+    return _derive_key(nym, 'envelope')
+
+
+def derive_journal_key(nym):
+    """Return the keys of the journal of the nym's conversation state"""
+    return _derive_key(nym, 'journal')
+
+
+def seal_data(key, data):
+    """Return the data encrypted (with AES-CTR) and authenticated (with
+    HMAC-SHA256)
+
+    :param tuple key: The keys for encryption and authentication
+    :rtype: str
+    """
+    encryption_key, mac_key = key
+    nonce = get_random_bytes(ENVELOPE_NONCE_LENGTH)
+    counter = Counter.new(128, initial_value=long(hexlify(nonce), 16))
+    cipher = AES.new(encryption_key, AES.MODE_CTR, counter=counter)
+    data = nonce + cipher.encrypt(data)
+    return data + hmac.new(mac_key, data, hashlib.sha256).digest()
+
+
+def open_data(key, sealed):
+    """Return the data sealed by seal_data(), or None if it cannot be
+    authenticated
+
+    :param tuple key: The keys for encryption and authentication
+    :rtype: str
+    """
+    encryption_key, mac_key = key
+    data = sealed[:-ENVELOPE_MAC_LENGTH]
+    mac = sealed[-ENVELOPE_MAC_LENGTH:]
+    if len(data) < ENVELOPE_NONCE_LENGTH or not hmac.compare_digest(
+            mac, hmac.new(mac_key, data, hashlib.sha256).digest()):
+        return None
+    nonce = data[:ENVELOPE_NONCE_LENGTH]
+    counter = Counter.new(128, initial_value=long(hexlify(nonce), 16))
+    cipher = AES.new(encryption_key, AES.MODE_CTR, counter=counter)
+    return cipher.decrypt(data[ENVELOPE_NONCE_LENGTH:])
+
+
+def seal_envelope(key, date, sender, subject):
+    """Return the Date header, sender and subject of a message encrypted
+    (with AES-CTR) and authenticated (with HMAC-SHA256)
+
+    Envelopes are much smaller and cheaper to decrypt than the messages, so
+    that the messages can be listed without being decrypted
+
+    :param tuple key: The keys returned by derive_envelope_key()
+    :rtype: str
+    """
+    # headers are byte strings, which are kept as they are by latin-1
+    fields = json.dumps([date, sender, subject], encoding='latin-1')
+    return seal_data(key, fields)
+
+
+def open_envelope(key, envelope):
+    """Return the Date header, sender and subject of a sealed envelope, or
+    None if it cannot be authenticated
+
+    :param tuple key: The keys returned by derive_envelope_key()
+    :param str envelope: The envelope returned by seal_envelope()
+    :rtype: tuple
+    """
+    fields = open_data(key, envelope)
+    if fields is None:
+        return None
+    try:
+        fields = json.loads(fields)
+        return tuple(f.encode('latin-1') if f is not None else None
+                     for f in fields)
+    except (ValueError, AttributeError, UnicodeError):
+        return None
+
+
+def journal_path(db_file):
+    """Return the path of the journal of a conversation state database"""
+    return db_file + '.journal'
+
+
+class Ratchet(object):
+    """The conversation state (Axolotl) of a nym with its server, kept in
+    memory while the nym is logged in
+
+    pyaxo reads (and decrypts) the whole database of the state before every
+    message and writes (and encrypts) it after, which is expensive. Instead,
+    the state is only loaded once, and every change is written to a journal,
+    that is sealed with a key derived from the passphrase of the nym
+    (much cheaper than encrypting the database with GPG) and replaced
+    atomically. The database is written when the state is saved (after a
+    batch of messages or when the session ends), and then the journal is
+    deleted. If the client stops before that, the journal is written to the
+    database the next time the state is loaded, so that old message keys
+    are never used again
+    """
+    def __init__(self, axolotl, nym):
+        """
+        :param axolotl: The object returned by create_axolotl()
+        :type axolotl: pyaxo.Axolotl
+        :param nym: The nym logged in, with passphrase and server
+        :type nym: nym.Nym
+        """
+        self._axolotl = axolotl
+        self._nym = nym
+        self._journal = journal_path(axolotl.dbname)
+        self._journal_key = None
+        self._loaded = False
+        self._changed = False
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._header_decryptions = 0
+
+    def _key(self):
+        if self._journal_key is None:
+            self._journal_key = derive_journal_key(self._nym)
+        return self._journal_key
+
+    def _recover(self):
+        """Write the state of the journal (if any) to the database"""
+        try:
+            with open(self._journal, 'rb') as f:
+                sql = open_data(self._key(), f.read())
+        except IOError:
+            return
+        if sql is None:
+            log.warning('Discarding journal that cannot be authenticated: '
+                        + self._journal)
+        else:
+            db = sqlite3.connect(':memory:')
+            db.executescript(sql)
+            self._axolotl.db = db
+            self._axolotl.writeDB()
+            log.info('Conversation state recovered from journal')
+        os.unlink(self._journal)
+
+    def _load(self):
+        if not self._loaded:
+            self._recover()
+            self._axolotl.loadState(self._nym.fingerprint, self._nym.server)
+            # the skipped keys are stored with the state, so that they are
+            # also journaled
+            self._axolotl.db.executescript(SKIPPED_KEYS_SCHEMA)
+            self._expire_skipped_keys()
+            # pyaxo only expires the keys skipped by previous versions when
+            # it skips more keys, which no longer happens, and each of them
+            # is tried (decrypting the message twice) until then
+            self._expire_skipped_keys('skipped_mk')
+            self._loaded = True
+
+    def _identities(self):
+        return self._axolotl.state['name'], self._axolotl.state['other_name']
+
+    def _expire_skipped_keys(self, table='skipped_keys'):
+        """Delete the skipped keys that are too old, then the oldest ones
+        above the limit"""
+        with self._axolotl.db as db:
+            db.execute('DELETE FROM ' + table + ' WHERE timestamp < ?',
+                       (int(time.time()) - SKIPPED_KEYS_LIFETIME,))
+            db.execute('DELETE FROM ' + table + ' WHERE rowid NOT IN '
+                       '(SELECT rowid FROM ' + table + ' '
+                       'ORDER BY timestamp DESC, rowid DESC LIMIT ?)',
+                       (SKIPPED_KEYS_LIMIT,))
+
+    def _store_skipped_keys(self, skipped_keys):
+        if not skipped_keys:
+            return
+        name, other_name = self._identities()
+        timestamp = int(time.time())
+        with self._axolotl.db as db:
+            db.executemany(
+                'REPLACE INTO skipped_keys (my_identity, other_identity, '
+                'header_key, number, message_key, timestamp) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(name, other_name, sqlite3.Binary(header_key), number,
+                  sqlite3.Binary(message_key), timestamp)
+                 for header_key, number, message_key in skipped_keys])
+        self._expire_skipped_keys()
+
+    def _decrypt_header(self, headers, header_key, data):
+        """Return the header decrypted with the key, remembering the result
+        for the message"""
+        if header_key not in headers:
+            self._header_decryptions += 1
+            headers[header_key] = self._axolotl.dec(header_key, data)
+        return headers[header_key]
+
+    def _try_skipped_keys(self, headers, header_data, body_data):
+        """Return the body decrypted with a skipped key, or None
+
+        Instead of trying every skipped key, the header is decrypted with
+        each (distinct) header key of the skipped keys, and the key is looked
+        up by the number of the message
+        """
+        db = self._axolotl.db
+        name, other_name = self._identities()
+        header_keys = db.execute(
+            'SELECT header_key FROM skipped_keys '
+            'WHERE my_identity = ? AND other_identity = ? '
+            'GROUP BY header_key ORDER BY MAX(timestamp) DESC',
+            (name, other_name)).fetchall()
+        for (header_key,) in header_keys:
+            header_key = str(header_key)
+            header = self._decrypt_header(headers, header_key, header_data)
+            if not header:
+                continue
+            row = db.execute(
+                'SELECT rowid, message_key FROM skipped_keys '
+                'WHERE header_key = ? AND number = ?',
+                (sqlite3.Binary(header_key), int(header[:3]))).fetchone()
+            if row is None:
+                return None
+            body = self._axolotl.dec(str(row[1]), body_data)
+            if body:
+                with db:
+                    db.execute('DELETE FROM skipped_keys WHERE rowid = ?',
+                               (row[0],))
+                return body
+            return None
+        return None
+
+    @staticmethod
+    def _skip_keys(header_key, first, last, chain_key):
+        """Return the keys of the messages from first to last (exclusive) of
+        a chain, the next chain key and the key of the last message"""
+        skipped_keys = []
+        for number in xrange(first, last):
+            skipped_keys.append((header_key, number,
+                                 hashlib.sha256(chain_key + '0').digest()))
+            chain_key = hashlib.sha256(chain_key + '1').digest()
+        message_key = hashlib.sha256(chain_key + '0').digest()
+        chain_key = hashlib.sha256(chain_key + '1').digest()
+        return skipped_keys, chain_key, message_key
+
+    def _decrypt(self, msg):
+        """Decrypt a message like pyaxo.Axolotl.decrypt() does, but keeping
+        the skipped keys indexed by their header keys and numbers. Return
+        None if the message could not be decrypted, without changing the
+        state"""
+        axolotl = self._axolotl
+        state = axolotl.state
+        pad_length = ord(msg[105:106])
+        header_data = msg[:106 - pad_length]
+        body_data = msg[106:]
+        headers = {}
+
+        body = self._try_skipped_keys(headers, header_data, body_data)
+        if body:
+            self._hits += 1
+            return body
+        # keys skipped by previous versions are only kept by pyaxo
+        with axolotl.db as db:
+            legacy = db.execute('SELECT 1 FROM skipped_mk LIMIT 1').fetchone()
+        if legacy:
+            body = axolotl.trySkippedMK(msg, pad_length, state['name'],
+                                        state['other_name'])
+            if body:
+                self._hits += 1
+                return body
+        self._misses += 1
+
+        header = None
+        if state['HKr']:
+            header = self._decrypt_header(headers, state['HKr'], header_data)
+        if header:
+            number = int(header[:3])
+            skipped_keys, chain_key, message_key = self._skip_keys(
+                state['HKr'], state['Nr'], number, state['CKr'])
+            body = axolotl.dec(message_key, body_data)
+            if not body:
+                return None
+        else:
+            header = self._decrypt_header(headers, state['NHKr'], header_data)
+            if state['ratchet_flag'] or not header:
+                return None
+            number = int(header[:3])
+            previous_number = int(header[3:6])
+            ratchet_key = header[6:]
+            skipped_keys = []
+            if state['CKr']:
+                skipped_keys, _, _ = self._skip_keys(
+                    state['HKr'], state['Nr'], previous_number, state['CKr'])
+            header_key = state['NHKr']
+            root_key = hashlib.sha256(
+                state['RK'] +
+                axolotl.genDH(state['DHRs_priv'], ratchet_key)).digest()
+            if axolotl.mode:
+                next_header_key = pbkdf2(root_key, b'\x04', 10,
+                                         prf='hmac-sha256')
+                chain_key = pbkdf2(root_key, b'\x06', 10, prf='hmac-sha256')
+            else:
+                next_header_key = pbkdf2(root_key, b'\x03', 10,
+                                         prf='hmac-sha256')
+                chain_key = pbkdf2(root_key, b'\x05', 10, prf='hmac-sha256')
+            more_skipped_keys, chain_key, message_key = self._skip_keys(
+                header_key, 0, number, chain_key)
+            skipped_keys += more_skipped_keys
+            body = axolotl.dec(message_key, body_data)
+            if not body:
+                return None
+            state['RK'] = root_key
+            state['HKr'] = header_key
+            state['NHKr'] = next_header_key
+            state['DHRr'] = ratchet_key
+            state['DHRs_priv'] = None
+            state['DHRs'] = None
+            state['ratchet_flag'] = True
+        self._store_skipped_keys(skipped_keys)
+        state['Nr'] = number + 1
+        state['CKr'] = chain_key
+        return body
+
+    def cache_info(self):
+        """Return the number of skipped keys stored, the number of messages
+        decrypted with (hits) and without (misses) them and the number of
+        headers decrypted to look them up
+
+        :rtype: dict
+        """
+        with self._lock:
+            self._load()
+            name, other_name = self._identities()
+            size = self._axolotl.db.execute(
+                'SELECT COUNT(*) FROM skipped_keys '
+                'WHERE my_identity = ? AND other_identity = ?',
+                (name, other_name)).fetchone()[0]
+            return {
+                'size': size,
+                'limit': SKIPPED_KEYS_LIMIT,
+                'hits': self._hits,
+                'misses': self._misses,
+                'header_decryptions': self._header_decryptions,
+            }
+
+    def _write_journal(self):
+        # the state is copied to the database in memory, without writing it
+        # to disk, so that it can be dumped
+        self._axolotl.writeDB = lambda: None
+        try:
+            self._axolotl.saveState()
+        finally:
+            del self._axolotl.writeDB
+        sql = '\n'.join(self._axolotl.db.iterdump())
+        temp = self._journal + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(seal_data(self._key(), sql))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, self._journal)
+        self._changed = True
+
+    def encrypt(self, data):
+        """Return the data encrypted with the next message key
+
+        The state is journaled before the ciphertext is returned, so that the
+        key is not used again if the client stops
+        """
+        with self._lock:
+            self._load()
+            ciphertext = self._axolotl.encrypt(data)
+            self._write_journal()
+            return ciphertext
+
+    def decrypt(self, data):
+        """Return the decrypted data, or None if it could not be decrypted
+
+        Messages received out of order are decrypted with the keys skipped
+        when the messages after them were decrypted
+        """
+        with self._lock:
+            self._load()
+            if len(data) < 106:
+                return None
+            plaintext = self._decrypt(data)
+            if plaintext is None:
+                return None
+            self._write_journal()
+            return plaintext
+
+    def save(self):
+        """Write the state to the database and delete the journal"""
+        with self._lock:
+            if self._changed:
+                self._axolotl.saveState()
+                if os.path.exists(self._journal):
+                    os.unlink(self._journal)
+                self._changed = False
+                log.debug('Conversation state saved')
+
+
 class Client:
     def __init__(self):
         self._cfg = ConfigParser.ConfigParser()
 
         self.use_agent = None
+        self.gpg_workers = None
         self.directory_base = None
         self.directory_db = None
         self.directory_read_messages = None
         self.directory_unread_messages = None
         self.file_hsub = None
         self.file_encrypted_hsub = None
+        self.file_spool = None
+        self.file_store = None
         self.logger_level = None
         self.output_method = None
         self.file_mix_binary = None
@@ -383,6 +920,27 @@ class Client:
         # create a GPG instance using nymphemeral's base directory as home
         self.gpg = new_gpg(self.directory_base)
 
+        # read and unread messages of every nym
+        self.store = MessageStore(self.file_store)
+        # number of unread messages of each nym, read from the store once and
+        # then updated as messages are added or deleted
+        self._unread_counter = None
+        # modification time of the unread messages directory when its
+        # messages were last moved to the store
+        self._unread_directory_mtime = None
+        # data version of the store when the unread messages were counted,
+        # which changes when other processes (such as the fetch command)
+        # change it
+        self._unread_data_version = None
+        self._unread_lock = Lock()
+        # messages are moved to the store by aampy's threads (as they are
+        # written) and by the GUI's, one at a time
+        self._import_lock = Lock()
+        # decryptions, encryptions and deliveries run in the background
+        self.jobs = JobExecutor()
+        # keys listed by gpg, indexed to be searched without calling it
+        self.keyring = KeyringIndex(self.gpg, self.directory_base)
+
         self._session = Session()
 
         # attributes to handle aampy (to retrieve new messages) using threads
@@ -458,15 +1016,41 @@ class Client:
             log.info('Mixmaster binary was not found or is not appropriate')
 
     def _initialize_aampy(self):
-        return AAMpy(self.directory_unread_messages,
+        spool = Spool(self.file_spool,
+                      self._cfg.getfloat('newsgroup', 'spool_days') * 86400)
+        aampy = AAMpy(self.directory_unread_messages,
                      group=self._cfg.get('newsgroup', 'group'),
                      server=self._cfg.get('newsgroup', 'server'),
-                     port=self._cfg.get('newsgroup', 'port'))
+                     port=self._cfg.get('newsgroup', 'port'),
+                     use_overview=self._cfg.getboolean('newsgroup',
+                                                       'use_overview'),
+                     pipeline_depth=self._cfg.getint('newsgroup',
+                                                     'pipeline_depth'),
+                     connections=self._cfg.getint('newsgroup', 'connections'),
+                     processes=self._cfg.getint('newsgroup', 'processes'),
+                     spool=spool)
+        aampy.add_listener(self._handle_aampy_event)
+        return aampy
+
+    def _handle_aampy_event(self, event):
+        # messages are moved to the store as soon as aampy writes them
+        if event.kind == MESSAGE:
+            self._import_unread_message(event.data['file_name'])
 
     def _wait_for_aampy(self):
         self.aampy.event.wait()
-        if self._session.hsubs and self.aampy.timestamp:
-            self._session.hsubs['time'] = self.aampy.timestamp
+        self._save_retrieval_progress()
+
+    def _save_retrieval_progress(self):
+        """Store where the last retrieval stopped along with the hSub
+        passphrases, so that the next one starts from there"""
+        if self._session.hsubs and (self.aampy.timestamp or
+                                    self.aampy.article_number):
+            if self.aampy.timestamp:
+                self._session.hsubs['time'] = self.aampy.timestamp
+            if self.aampy.article_number:
+                self._session.hsubs[self.aampy.article_key] = \
+                    self.aampy.article_number
             self.save_hsubs(self._session.hsubs)
 
     def _decrypt_hsubs_file(self):
@@ -480,41 +1064,179 @@ class Client:
                      'It does not exist')
         return None
 
-    def _append_messages_to_list(self, read_messages, messages, messages_without_date):
-        # check which directory to read the files from
-        if read_messages:
-            path = self.directory_read_messages
-        else:
-            path = self.directory_unread_messages
-        files = files_in_path(path)
-        for file_name in files:
-            if re.match('message_' + self._session.nym.address + '_.*',
-                        file_name):
-                file_path = os.path.join(path, file_name)
+    def _import_unread_messages(self):
+        """Move the messages aampy stored in the unread messages directory
+        to the message store
+
+        The directory is only listed if it was modified since the last time,
+        as aampy's messages are usually moved as soon as they are written
+        """
+        try:
+            mtime = os.stat(self.directory_unread_messages).st_mtime
+        except OSError:
+            return
+        with self._unread_lock:
+            if mtime == self._unread_directory_mtime:
+                return
+            self._unread_directory_mtime = mtime
+        for file_name in files_in_path(self.directory_unread_messages):
+            self._import_unread_message(file_name)
+
+    def _import_unread_message(self, file_name):
+        nym = re.match(r'message_(.+)_.{5}\.txt$', file_name)
+        if not nym:
+            return
+        nym = nym.group(1)
+        file_path = os.path.join(self.directory_unread_messages, file_name)
+        with self._import_lock:
+            if not os.path.exists(file_path):
+                # already moved
+                return
+            if not self.store.contains(nym, file_name, True):
                 data = read_data(file_path)
-                if read_messages:
-                    decrypted_data = decrypt_data(self.gpg,
-                                                  data,
-                                                  self._session.nym.passphrase)
-                    if decrypted_data:
-                        data = decrypted_data
-                    elif not search_pgp_message(data):
-                        encrypted_data = encrypt_data(
-                            self.gpg,
-                            data,
-                            self._session.nym.address,
-                            self._session.nym.fingerprint,
-                            self._session.nym.passphrase
-                        )
-                        if encrypted_data:
-                            save_data(encrypted_data, file_path)
-                            log.debug(file_path.split(PATHSEP)[-1] + ' is now'
-                                      'encrypted')
-                new_message = Message(not read_messages, data, file_path)
-                if new_message.date:
-                    messages.append(new_message)
+                if data is None:
+                    return
+                date = parse_headers(data.splitlines(), ('date',)).get('date')
+                self.store.add(nym, data, True, name=file_name,
+                               date=parse_timestamp(date), date_header=date)
+                self._count_unread_message(nym, 1)
+            try:
+                os.unlink(file_path)
+            except OSError:
+                log.error('OSError while deleting ' + file_path)
+
+    def _count_unread_message(self, nym, increment):
+        with self._unread_lock:
+            if self._unread_counter is not None:
+                count = self._unread_counter.get(nym, 0) + increment
+                if count > 0:
+                    self._unread_counter[nym] = count
+                else:
+                    self._unread_counter.pop(nym, None)
+
+    def _run_in_workers(self, function, items):
+        """Yield the results of the function applied to the items as they are
+        completed by a bounded pool of threads. Used for operations that run
+        gpg, so that several gpg processes run concurrently"""
+        items = list(items)
+        if self.gpg_workers <= 1 or len(items) <= 1:
+            for item in items:
+                yield function(item)
+            return
+        pool = ThreadPool(min(self.gpg_workers, len(items)))
+        try:
+            for result in pool.imap_unordered(function, items):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _read_saved_message(self, file_name):
+        """Return a message saved by previous versions and its ciphertext,
+        encrypting it if needed. Return None if it cannot be read"""
+        file_path = os.path.join(self.directory_read_messages, file_name)
+        data = read_data(file_path)
+        if data is None:
+            return None
+        decrypted_data = decrypt_data(self.gpg,
+                                      data,
+                                      self._session.nym.passphrase)
+        if decrypted_data:
+            return Message(False, decrypted_data, None), data
+        if search_pgp_message(data):
+            log.warn(file_name + ' could not be decrypted. It will not be '
+                     'imported')
+            return None
+        encrypted_data = encrypt_data(self.gpg,
+                                      data,
+                                      self._session.nym.address,
+                                      self._session.nym.fingerprint,
+                                      self._session.nym.passphrase)
+        if not encrypted_data:
+            log.warn(file_name + ' could not be encrypted. It will not be '
+                     'imported')
+            return None
+        return Message(False, data, None), encrypted_data
+
+    def _import_read_messages(self):
+        """Move the messages of the nym saved in the read messages directory
+        (by previous versions) to the message store. Messages that were not
+        encrypted are encrypted before being stored. Files are decrypted (or
+        encrypted) concurrently"""
+        file_names = []
+        for file_name in files_in_path(self.directory_read_messages):
+            if re.match('message_' + re.escape(self._session.nym.address) +
+                        '_.*', file_name):
+                if self.store.contains(self._session.nym.address, file_name,
+                                       False):
+                    self._delete_saved_message(file_name)
                 else:
-                    messages_without_date.append(new_message)
+                    file_names.append(file_name)
+
+        def read(file_name):
+            return file_name, self._read_saved_message(file_name)
+
+        for file_name, result in self._run_in_workers(read, file_names):
+            if result:
+                message, ciphertext = result
+                self._store_read_message(message, ciphertext, file_name)
+                log.debug(file_name + ' was imported to the message store')
+                self._delete_saved_message(file_name)
+
+    def _delete_saved_message(self, file_name):
+        file_path = os.path.join(self.directory_read_messages, file_name)
+        try:
+            os.unlink(file_path)
+        except OSError:
+            log.error('OSError while deleting ' + file_path)
+
+    def _envelope_key(self):
+        if self._session.envelope_key is None:
+            self._session.envelope_key = derive_envelope_key(self._session.nym)
+        return self._session.envelope_key
+
+    def _store_read_message(self, msg, ciphertext, name=None):
+        date = msg.processed_message.get('Date')
+        envelope = seal_envelope(self._envelope_key(), date, msg.sender,
+                                 msg.subject)
+        return self.store.add(self._session.nym.address, ciphertext, False,
+                              name=name,
+                              date=parse_timestamp(date),
+                              envelope=envelope)
+
+    def _read_envelope(self, stored_message):
+        """Return the Date header, sender and subject of a read message from
+        its envelope, or None if the envelope cannot be opened (if the
+        passphrase changed) or the message was stored without one (by
+        previous versions)
+        """
+        if stored_message.envelope is None:
+            return None
+        return open_envelope(self._envelope_key(), stored_message.envelope)
+
+    def _recreate_envelope(self, stored_message):
+        """Decrypt a read message to recreate its envelope. Return the Date
+        header, sender and subject"""
+        data = self._load_message_body(stored_message.id, False)
+        msg = Message(False, data, stored_message.id)
+        metadata = (msg.processed_message.get('Date'), msg.sender,
+                    msg.subject)
+        self.store.set_envelope(stored_message.id,
+                                seal_envelope(self._envelope_key(), *metadata))
+        return metadata
+
+    def _load_message_body(self, identifier, is_unread):
+        """Return a stored message, decrypting the ones that were read"""
+        data = self.store.body(identifier)
+        if data is None or is_unread:
+            return data
+        decrypted_data = decrypt_data(self.gpg,
+                                      data,
+                                      self._session.nym.passphrase)
+        if decrypted_data:
+            return decrypted_data
+        log.warn('Message could not be decrypted')
+        return data
 
     def _encrypt_e2ee_data(self, data, target,
                            signer=None, passphrase=None, throw_keyids=False):
@@ -584,6 +1306,7 @@ class Client:
             # load default configs
             self._cfg.add_section('gpg')
             self._cfg.set('gpg', 'use_agent', 'True')
+            self._cfg.set('gpg', 'workers', '4')
             self._cfg.add_section('main')
             self._cfg.set('main', 'base_dir', NYMPHEMERAL_PATH)
             self._cfg.set('main', 'db_dir',
@@ -598,6 +1321,10 @@ class Client:
                           os.path.join('%(base_dir)s', 'hsubs.txt'))
             self._cfg.set('main', 'encrypted_hsub_file',
                           os.path.join('%(base_dir)s', 'encrypted_hsubs.txt'))
+            self._cfg.set('main', 'spool_file',
+                          os.path.join('%(base_dir)s', 'spool.txt'))
+            self._cfg.set('main', 'store_file',
+                          os.path.join('%(base_dir)s', 'messages.db'))
             self._cfg.set('main', 'logger_level', 'warning')
             self._cfg.set('main', 'output_method', 'manual')
             self._cfg.add_section('mixmaster')
@@ -608,6 +1335,11 @@ class Client:
             self._cfg.set('newsgroup', 'group', 'alt.anonymous.messages')
             self._cfg.set('newsgroup', 'server', 'localhost')
             self._cfg.set('newsgroup', 'port', '119')
+            self._cfg.set('newsgroup', 'use_overview', 'True')
+            self._cfg.set('newsgroup', 'pipeline_depth', '16')
+            self._cfg.set('newsgroup', 'connections', '1')
+            self._cfg.set('newsgroup', 'processes', '1')
+            self._cfg.set('newsgroup', 'spool_days', '7')
 
             # parse existing configs in case:
             #   - new versions add/remove sections/options
@@ -668,12 +1400,15 @@ class Client:
             self.save_configs()
 
             self.use_agent = self._cfg.getboolean('gpg', 'use_agent')
+            self.gpg_workers = self._cfg.getint('gpg', 'workers')
             self.directory_base = self._cfg.get('main', 'base_dir')
             self.directory_db = self._cfg.get('main', 'db_dir')
             self.directory_read_messages = self._cfg.get('main', 'read_dir')
             self.directory_unread_messages = self._cfg.get('main', 'unread_dir')
             self.file_hsub = self._cfg.get('main', 'hsub_file')
             self.file_encrypted_hsub = self._cfg.get('main', 'encrypted_hsub_file')
+            self.file_spool = self._cfg.get('main', 'spool_file')
+            self.file_store = self._cfg.get('main', 'store_file')
 
             log.debug('Configs have been loaded')
         except IOError:
@@ -693,34 +1428,23 @@ class Client:
         # also used to update an identity
         if server:
             self.gpg.delete_keys(self.retrieve_servers()[server])
-        return self.gpg.import_keys(key)
+        result = self.gpg.import_keys(key)
+        self.keyring.invalidate()
+        return result
 
     def delete_key(self, server):
-        return self.gpg.delete_keys(self.retrieve_servers()[server])
+        result = self.gpg.delete_keys(self.retrieve_servers()[server])
+        self.keyring.invalidate()
+        return result
 
     def import_default_keys(self):
         """Import public keys included in nymphemeral to the client keyring."""
         for key in read_default_keys().values():
             self.gpg.import_keys(key)
+        self.keyring.invalidate()
 
     def retrieve_servers(self):
-        servers = {}
-        keys = self.gpg.list_keys()
-        for item in keys:
-            config_match = None
-            send_match = None
-            url_match = None
-            for uid in item['uids']:
-                if not config_match:
-                    config_match = re.search(r'\bconfig@(\S+)\b', uid, flags=re.IGNORECASE)
-                if not send_match:
-                    send_match = re.search(r'\bsend@(\S+)+\b', uid, flags=re.IGNORECASE)
-                if not url_match:
-                    url_match = re.search(r'\burl@(\S+)\b', uid, flags=re.IGNORECASE)
-            if config_match and send_match and url_match:
-                server = config_match.group(1)
-                servers[server] = item['fingerprint']
-        return servers
+        return dict(self.keyring.servers)
 
     def retrieve_nyms(self):
         """Retrieve nyms owned by the user by searching the keyring for secret
@@ -729,9 +1453,9 @@ class Client:
 
         :rtype: list
         """
-        servers = self.retrieve_servers()
+        servers = self.keyring.servers
         nyms = []
-        key_map = self.gpg.list_keys(secret=True).key_map
+        key_map = self.keyring.secret_keys
         for fp, key in key_map.iteritems():
             try:
                 uid = key['uids'][0]
@@ -765,9 +1489,9 @@ class Client:
         """
         def matches(info):
             return info.lower().endswith(search_query)
-        servers = self.retrieve_servers()
+        servers = self.keyring.servers
         nyms = []
-        key_map = self.gpg.list_keys(secret=True).key_map
+        key_map = self.keyring.secret_keys
         for fp, key in key_map.iteritems():
             uid = None
             try:
@@ -775,7 +1499,7 @@ class Client:
                 if fp.endswith(key['keyid']):
                     if matches(fp) or matches(key['fingerprint']):
                         uid = key['uids'][0]
-                    elif re.search(r'\b' + search_query + r'\b',
+                    elif re.search(r'\b' + re.escape(search_query) + r'\b',
                                    key['uids'][0],
                                    flags=re.IGNORECASE):
                         uid = key['uids'][0]
@@ -819,7 +1543,8 @@ class Client:
             if not nym.fingerprint:
                 raise errors.FingerprintNotFoundError(nym.address)
             self._check_passphrase(nym)
-            self._session.axolotl = create_axolotl(nym, self.directory_db)
+            self._session.ratchet = Ratchet(
+                create_axolotl(nym, self.directory_db), nym)
         self._session.nym = nym
         self._session.hsubs = self.retrieve_hsubs()
         if not creating_nym:
@@ -827,8 +1552,25 @@ class Client:
         self.check_configs(use_agent, output_method)
 
     def end_session(self):
+        # the jobs submitted during the session use its nym and conversation
+        # state
+        self.jobs.join()
+        self.save_state()
         self._session = Session()
 
+    def close(self):
+        """Stop the jobs (after the ones submitted are done), save the
+        conversation state and close the message store. The client cannot
+        be used after that"""
+        self.jobs.shutdown()
+        self.save_state()
+        self.store.close()
+
+    def save_state(self):
+        """Write the conversation state of the nym logged in to disk"""
+        if self._session.ratchet:
+            self._session.ratchet.save()
+
     def check_configs(self, use_agent, output_method):
         update = False
 
@@ -882,8 +1624,7 @@ class Client:
     def delete_hsub(self, nym):
         del self._session.hsubs[nym.address]
         # check if there are no hSub passphrases anymore
-        if not self._session.hsubs or len(self._session.hsubs) == 1 \
-                and 'time' in self._session.hsubs:
+        if not hsub_passphrases(self._session.hsubs):
             if self._decrypt_hsubs_file():
                 hsub_file = self.file_encrypted_hsub
             else:
@@ -912,14 +1653,16 @@ class Client:
                 # check if there are unencrypted hSub passphrases
                 if hsubs:
                     encrypt_hsubs = True
-                    # merge hSub passphrases and save the "older" time to ensure messages are not skipped
-                    try:
-                        if hsubs['time'] < decrypted_hsubs['time']:
-                            hsubs = dict(decrypted_hsubs.items() + hsubs.items())
-                        else:
-                            hsubs = dict(hsubs.items() + decrypted_hsubs.items())
-                    except KeyError:
-                        hsubs = dict(hsubs.items() + decrypted_hsubs.items())
+                    # merge hSub passphrases and save the "older" time and
+                    # article numbers to ensure messages are not skipped
+                    merged_hsubs = dict(hsubs.items() + decrypted_hsubs.items())
+                    passphrases = hsub_passphrases(merged_hsubs)
+                    for key in set(hsubs) & set(decrypted_hsubs):
+                        if key not in passphrases:
+                            merged_hsubs[key] = min(hsubs[key],
+                                                    decrypted_hsubs[key],
+                                                    key=float)
+                    hsubs = merged_hsubs
                 else:
                     hsubs = decrypted_hsubs
         else:
@@ -929,12 +1672,99 @@ class Client:
         return hsubs
 
     def retrieve_messages_from_disk(self):
+        """Return the messages of the nym, from the newest to the oldest.
+        Only the envelopes of the read messages are decrypted, while their
+        bodies are only loaded (and decrypted) when needed"""
+        return list(self.iter_messages())
+
+    def retrieve_unread_message(self, file_name):
+        """Return the unread message of the nym logged in that aampy stored
+        in the file, or None
+
+        The file was already moved to the message store by the client, which
+        listens to aampy before anyone else
+        """
+        stored_message = self.store.find(self._session.nym.address, file_name,
+                                         True)
+        if stored_message is None:
+            return None
+        return self._create_messages([stored_message])[0]
+
+    def iter_messages(self, nym=None, offset=0, limit=None,
+                      order=NEWEST_FIRST, after=None):
+        """Yield the messages of the nym (the one logged in, by default) in
+        the order of their dates, reading a page of the message store at a
+        time
+
+        The messages downloaded by aampy (and the ones saved by previous
+        versions) are moved to the message store when the first message is
+        requested. Only the nym logged in can open the envelopes of its read
+        messages, so the read messages of other nyms have no metadata
+
+        :param str nym: The address of the nym
+        :param int offset: The number of messages skipped
+        :param int limit: The maximum number of messages, or None for all
+        :param str order: store.NEWEST_FIRST or store.OLDEST_FIRST
+        :param tuple after: The sort key of the message (Message.sort_key)
+            the messages follow, or None to start from the first one
+        """
+        if nym is None:
+            nym = self._session.nym.address
+        logged_in = nym == self._session.nym.address
+        if offset == 0 and after is None:
+            self._import_unread_messages()
+            if logged_in:
+                self._import_read_messages()
+        while limit is None or limit > 0:
+            page_size = MESSAGES_PAGE_SIZE
+            if limit is not None:
+                page_size = min(page_size, limit)
+            stored_messages = self.store.messages(nym, offset, page_size,
+                                                  order, after=after)
+            for msg in self._create_messages(stored_messages, logged_in):
+                yield msg
+            if len(stored_messages) < page_size:
+                return
+            # the next pages follow the last message, even if messages are
+            # stored or deleted meanwhile
+            offset = 0
+            after = sort_key(stored_messages[-1])
+            if limit is not None:
+                limit -= page_size
+
+    def _create_messages(self, stored_messages, logged_in=True):
+        """Return the messages (whose bodies are loaded when needed) of a page
+        of the message store"""
+        metadata = []
+        envelopes_to_recreate = []
+        for i, m in enumerate(stored_messages):
+            if m.unread:
+                metadata.append((m.date_header, None, None))
+            elif not logged_in:
+                metadata.append((None, None, None))
+            else:
+                metadata.append(self._read_envelope(m))
+                if metadata[i] is None:
+                    envelopes_to_recreate.append(i)
+
+        def recreate_envelope(i):
+            return i, self._recreate_envelope(stored_messages[i])
+
+        for i, result in self._run_in_workers(recreate_envelope,
+                                              envelopes_to_recreate):
+            metadata[i] = result
+
+        # the messages are kept in the order they were stored
         messages = []
-        messages_without_date = []
-        self._append_messages_to_list(False, messages, messages_without_date)
-        self._append_messages_to_list(True, messages, messages_without_date)
-        messages = sorted(messages, key=lambda item: item.date, reverse=True)
-        messages += messages_without_date
+        for m, (date, sender, subject) in zip(stored_messages, metadata):
+            def load(identifier=m.id, is_unread=bool(m.unread)):
+                return self._load_message_body(identifier, is_unread)
+            messages.append(Message(bool(m.unread), None, m.id,
+                                    date=date,
+                                    sender=sender,
+                                    subject=subject,
+                                    sort_key=sort_key(m),
+                                    load=load))
         return messages
 
     def send_create(self, name, duration, ephemeral=None, hsub=None):
@@ -965,6 +1795,7 @@ class Client:
                                  self._session.nym.address,
                                  self._session.nym.passphrase,
                                  duration)
+        self.keyring.invalidate()
         nym = self.retrieve_nym(self._session.nym.address)
         nym.passphrase = self._session.nym.passphrase
         nym.hsub = hsub
@@ -985,7 +1816,7 @@ class Client:
             create_state(axolotl=axolotl,
                          other_name=self._session.nym.server,
                          mkey=ephemeral)
-            self._session.axolotl = axolotl
+            self._session.ratchet = Ratchet(axolotl, nym)
             self._session.nym = nym
             self.add_hsub(self._session.nym)
         return success, info, ciphertext
@@ -1011,7 +1842,7 @@ class Client:
         e2ee_target_info = ''
         if e2ee_target or e2ee_signer:
             if e2ee_target:
-                e2ee_target_key = retrieve_key(self.gpg, e2ee_target)
+                e2ee_target_key = retrieve_key(self.keyring, e2ee_target)
                 e2ee_target_fp = e2ee_target_key['fingerprint']
                 e2ee_target_info = ('End-to-End Encryption to:' + LINESEP +
                                     format_key_info(e2ee_target_key) + LINESEP)
@@ -1020,7 +1851,7 @@ class Client:
                     body = self._encrypt_e2ee_data(
                         data=body,
                         target=e2ee_target_fp,
-                        signer=retrieve_fingerprint(self.gpg, e2ee_signer),
+                        signer=retrieve_fingerprint(self.keyring, e2ee_signer),
                         passphrase=passphrase,
                         throw_keyids=throw_keyids
                     )
@@ -1035,7 +1866,7 @@ class Client:
                 # sign only
                 body = self._sign_data(
                     data=body,
-                    signer=retrieve_fingerprint(self.gpg, e2ee_signer),
+                    signer=retrieve_fingerprint(self.keyring, e2ee_signer),
                     passphrase=passphrase
                 )
 
@@ -1053,10 +1884,7 @@ class Client:
         content = LINESEP.join(lines)
         msg = message_from_string(content).as_string()
 
-        self._session.axolotl.loadState(self._session.nym.fingerprint,
-                                        self._session.nym.server)
-        ciphertext = b2a_base64(self._session.axolotl.encrypt(msg)).strip()
-        self._session.axolotl.saveState()
+        ciphertext = b2a_base64(self._session.ratchet.encrypt(msg)).strip()
 
         lines = [ciphertext[i:i + 64] for i in xrange(0, len(ciphertext), 64)]
         lines.insert(0, '-----BEGIN PGP MESSAGE-----' + LINESEP)
@@ -1108,6 +1936,7 @@ class Client:
                 create_state(axolotl=axolotl,
                              other_name=self._session.nym.server,
                              mkey=ephemeral)
+                self._session.ratchet = Ratchet(axolotl, self._session.nym)
             if hsub:
                 self._session.nym.hsub = hsub
                 self.add_hsub(self._session.nym)
@@ -1122,13 +1951,16 @@ class Client:
             recipient='config@'+self._session.nym.server
         )
         if success:
-            if os.path.exists(db_file):
-                os.unlink(db_file)
+            self._session.ratchet = None
+            for path in [db_file, journal_path(db_file)]:
+                if os.path.exists(path):
+                    os.unlink(path)
             self.delete_hsub(self._session.nym)
             # delete secret key
             self.gpg.delete_keys(self._session.nym.fingerprint, True)
             # delete public key
             self.gpg.delete_keys(self._session.nym.fingerprint)
+            self.keyring.invalidate()
         return success, info, ciphertext
 
     def encrypt_and_send(self, data, recipient):
@@ -1138,8 +1970,9 @@ class Client:
         if ciphertext:
             success = True
             if self.output_method == 'manual':
+                # the GUI copies the ciphertext to the clipboard, as Tk
+                # cannot be used by the threads that send messages
                 info = 'Send the following message to ' + recipient
-                copy_to_clipboard(ciphertext)
                 info += LINESEP + 'It has been copied to the clipboard'
             else:
                 data = 'To: ' + recipient + LINESEP*2 + ciphertext
@@ -1168,16 +2001,22 @@ class Client:
             return True
 
     def count_unread_messages(self):
-        counter = {}
-        messages = files_in_path(self.directory_unread_messages)
-        for m in messages:
-            nym = re.search('(?<=message_).+(?=_.{5}.txt)', m)
-            if nym:
-                try:
-                    counter[nym.group()] += 1
-                except KeyError:
-                    counter[nym.group()] = 1
-        return counter
+        """Return the number of unread messages indexed by the nyms
+
+        The messages are counted in the store only the first time (or after
+        another process changed it), and then the counter is updated as
+        messages are added and deleted
+        """
+        self._import_unread_messages()
+        # the messages being imported are either counted in the store or
+        # added to the counter, but not both
+        with self._import_lock, self._unread_lock:
+            data_version = self.store.data_version()
+            if (self._unread_counter is None or
+                    data_version != self._unread_data_version):
+                self._unread_counter = self.store.count_unread()
+                self._unread_data_version = data_version
+            return dict(self._unread_counter)
 
     def start_aampy(self):
         self.aampy.reset()
@@ -1194,23 +2033,42 @@ class Client:
     def stop_aampy(self):
         self.aampy.stop()
 
-    def decrypt_ephemeral_data(self, data):
-        ciphertext = None
-        self._session.axolotl.loadState(self._session.nym.fingerprint,
-                                        self._session.nym.server)
-        # workaround to suppress prints by pyaxo
-        sys.stdout = open(os.devnull, 'w')
+    def retrieve_messages(self):
+        """Retrieve the new messages of the nyms (with aampy) in the current
+        thread, moving them to the message store
+
+        :return: Whether every new article was checked and the number of
+            messages found for each nym
+        :rtype: tuple
+        """
+        found = {}
+        finished = {}
+
+        def handle_event(event):
+            if event.kind == MESSAGE:
+                nick = event.data['nick']
+                found[nick] = found.get(nick, 0) + 1
+            elif event.kind == FINISHED:
+                finished.update(event.data)
+
+        self.aampy.reset()
+        self.aampy.add_listener(handle_event)
         try:
-            ciphertext = self._session.axolotl.decrypt(a2b_base64(data)).strip()
-        except SystemExit:
-            sys.stdout = sys.__stdout__
+            self.aampy.retrieve_messages(self._session.hsubs)
+        finally:
+            self.aampy.remove_listener(handle_event)
+        self._save_retrieval_progress()
+        self._import_unread_messages()
+        return finished.get('completed', False), found
+
+    def decrypt_ephemeral_data(self, data):
+        ciphertext = self._session.ratchet.decrypt(a2b_base64(data))
+        if ciphertext is None:
             log.info('Error while decrypting message')
-        else:
-            sys.stdout = sys.__stdout__
-            self._session.axolotl.saveState()
-        return ciphertext
+            return None
+        return ciphertext.strip()
 
-    def decrypt_ephemeral_message(self, msg):
+    def _ephemeral_data(self, msg):
         exp = re.compile('^[A-Za-z0-9+\/=]+\Z')
         buf = msg.content.splitlines()
         data = ''
@@ -1218,27 +2076,87 @@ class Client:
             if len(item.strip()) % 4 == 0 and exp.match(item) and len(
                     item.strip()) <= 64 and not item.startswith(' '):
                 data += item
-        ciphertext = self.decrypt_ephemeral_data(data)
-        self.delete_message_from_disk(msg)
+        return data
+
+    def _decrypt_asymmetric_layer(self, ciphertext):
+        """Return the message of the ciphertext decrypted from the ephemeral
+        layer, decrypting the asymmetric layer encrypted by the server"""
+        log.debug('Ephemeral layer decrypted')
+        plaintext = decrypt_data(self.gpg,
+                                 ciphertext,
+                                 self._session.nym.passphrase)
+        if plaintext:
+            log.debug('Asymmetric layer decrypted')
+        else:
+            plaintext = ciphertext
+            if search_pgp_message(ciphertext):
+                log.debug('Asymmetric layer not decrypted')
+                plaintext = ('The asymmetric layer encrypted by the '
+                             'server could not be decrypted:' +
+                             LINESEP*2 +
+                             ciphertext)
+        return Message(False, plaintext, None)
+
+    def decrypt_ephemeral_message(self, msg):
+        ciphertext = self.decrypt_ephemeral_data(self._ephemeral_data(msg))
         if ciphertext:
-            log.debug('Ephemeral layer decrypted')
-            plaintext = decrypt_data(self.gpg,
-                                     ciphertext,
-                                     self._session.nym.passphrase)
-            if plaintext:
-                log.debug('Asymmetric layer decrypted')
-            else:
-                plaintext = ciphertext
-                if search_pgp_message(ciphertext):
-                    log.debug('Asymmetric layer not decrypted')
-                    plaintext = ('The asymmetric layer encrypted by the '
-                                 'server could not be decrypted:' +
-                                 LINESEP*2 +
-                                 ciphertext)
-            return Message(False, plaintext, msg.identifier)
+            self.delete_message_from_disk(msg)
+            return self._decrypt_asymmetric_layer(ciphertext)
         else:
+            # the message is kept, as it may be decrypted after the messages
+            # sent before it are received
             raise errors.UndecipherableMessageError()
 
+    def decrypt_unread_messages(self):
+        """Decrypt all the unread messages of the nym logged in
+
+        The ephemeral layers are decrypted (by the ratchet) in the order the
+        messages arrived, then the asymmetric layers are decrypted
+        concurrently, and the conversation state is saved once for the whole
+        batch. Messages that cannot be decrypted yet (sent after messages of
+        the batch that arrived later) are tried again until no more messages
+        are decrypted, and are kept if they still cannot be decrypted
+
+        :return: A list of tuples of the identifier of each unread message
+            and its decrypted message (or None if it could not be decrypted),
+            in the order the messages arrived
+        :rtype: list
+        """
+        self._import_unread_messages()
+        unread_messages = self._create_messages(
+            self.store.messages(self._session.nym.address, order=OLDEST_FIRST,
+                                unread=True))
+        # the identifiers are cleared when the messages are deleted
+        identifiers = [m.identifier for m in unread_messages]
+        ciphertexts = [None] * len(unread_messages)
+        pending = range(len(unread_messages))
+        while pending:
+            failed = []
+            for i in pending:
+                msg = unread_messages[i]
+                ciphertexts[i] = self.decrypt_ephemeral_data(
+                    self._ephemeral_data(msg))
+                if ciphertexts[i]:
+                    self.delete_message_from_disk(msg)
+                else:
+                    failed.append(i)
+            if len(failed) == len(pending):
+                break
+            pending = failed
+        self.save_state()
+        log.debug('Skipped keys: %s', self._session.ratchet.cache_info())
+
+        def decrypt(i):
+            return i, self._decrypt_asymmetric_layer(ciphertexts[i])
+
+        results = [None] * len(unread_messages)
+        for i, decrypted in self._run_in_workers(
+                decrypt, [i for i, c in enumerate(ciphertexts) if c]):
+            results[i] = decrypted
+        log.info('%d of %d unread messages decrypted',
+                 len(filter(None, results)), len(results))
+        return zip(identifiers, results)
+
     def decrypt_e2ee_message(self, msg, passphrase=None):
         """Return plaintext of end-to-end encrypted message using nymphemeral's keyring"""
         data = search_pgp_message(msg.content)
@@ -1288,36 +2206,36 @@ class Client:
             raise errors.UndecipherableMessageError()
 
     def save_message_to_disk(self, msg):
+        data = msg.processed_message.as_string()
+        ciphertext = encrypt_data(self.gpg,
+                                  data,
+                                  self._session.nym.address,
+                                  self._session.nym.fingerprint,
+                                  self._session.nym.passphrase)
+        if not ciphertext:
+            log.error('Message encryption failed. It will not be saved')
+            return False
         try:
-            new_identifier = os.path.join(self.directory_read_messages,
-                                          msg.identifier.split(PATHSEP)[-1])
-            data = msg.processed_message.as_string()
-            ciphertext = encrypt_data(self.gpg,
-                                      data,
-                                      self._session.nym.address,
-                                      self._session.nym.fingerprint,
-                                      self._session.nym.passphrase)
-            if ciphertext:
-                data = ciphertext
-            else:
-                log.warn('Message encryption failed. Will be saved as plain'
-                         'text')
-            if save_data(data, new_identifier):
-                log.info('Message saved to disk')
-                msg.identifier = new_identifier
-                return True
-            else:
-                log.error('Message could not be saved')
-        except IOError:
-            log.error('IOError while saving message to disk')
-        return False
+            msg.identifier = self._store_read_message(msg, ciphertext)
+        except sqlite3.Error:
+            log.error('Error while saving message to the message store')
+            return False
+        log.info('Message saved to disk')
+        return True
 
     def delete_message_from_disk(self, msg):
-        try:
-            if os.path.exists(msg.identifier):
-                os.unlink(msg.identifier)
-                log.info('Message deleted from disk')
+        if msg.identifier is None:
             return True
-        except IOError:
-            log.error('IOError while deleting from disk')
-        return False
+        # load the message before its body is deleted, so that it can still
+        # be displayed and saved again
+        msg.processed_message
+        try:
+            deleted = self.store.delete(msg.identifier)
+        except sqlite3.Error:
+            log.error('Error while deleting message from the message store')
+            return False
+        if deleted and msg.is_unread:
+            self._count_unread_message(self._session.nym.address, -1)
+        msg.identifier = None
+        log.info('Message deleted from disk')
+        return True
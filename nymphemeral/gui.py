@@ -1,22 +1,29 @@
 #!/usr/bin/env python
 import logging
 import operator
-import os
 import sys
 import Tkinter as Tk
 import tkMessageBox
 import tkSimpleDialog
 import ttk
+from Queue import Empty
 
 from . import __version__
 from . import errors
 from . import LINESEP
+from .aampy import ERROR, FINISHED, MESSAGE, PROGRESS
 from .client import DEBUG_LOGGER_LEVEL, OUTPUT_METHOD
 from .client import format_key_info
-from .client import retrieve_key, retrieve_keyids, search_pgp_message
+from .client import MESSAGES_PAGE_SIZE, retrieve_key, retrieve_keyids, search_pgp_message
 from .client import Client
 from .nym import Nym
 
+# milliseconds between checks for events of the message retrieval
+RETRIEVAL_EVENTS_INTERVAL = 100
+# milliseconds between checks for jobs done in the background
+JOB_CHECK_INTERVAL = 50
+
+
 log = logging.getLogger(__name__)
 
 
@@ -30,6 +37,31 @@ def write_on_text(text, content, clear=True):
     text.config(state=state)
 
 
+def write_sent_message(client, text, info, ciphertext):
+    """Write a message that was encrypted and sent on the text, copying it
+    to the clipboard if it has to be sent manually"""
+    if client.output_method == 'manual':
+        text.clipboard_clear()
+        text.clipboard_append(ciphertext)
+    write_on_text(text, [info, ciphertext])
+
+
+def when_done(widget, job, callback):
+    """Call the callback with a job run in the background (by the client's
+    job executor) when it is done. The callback is called by the main loop
+    of the widget, so that it can update the interface"""
+    try:
+        if not widget.winfo_exists():
+            return
+    except Tk.TclError:
+        # the window of the widget was destroyed when the session ended
+        return
+    if job.done():
+        widget.after_idle(callback, job)
+    else:
+        widget.after(JOB_CHECK_INTERVAL, when_done, widget, job, callback)
+
+
 def set_widget_state(enable, widget):
     if enable:
         state = Tk.NORMAL
@@ -53,6 +85,128 @@ def bind_checkbutton_and_entry(checkbutton, entry, enable=False):
     bind_handler_to_widget_events(handler, checkbutton, events)
 
 
+class VirtualList(Tk.Frame, object):
+    """A list box with a scroll bar that only has the rows that are visible
+
+    The rows are not stored by the list box. The text of each row is read
+    (with the function given) when the row is shown, so that lists with
+    thousands of rows are not slower than short ones
+    """
+    def __init__(self, parent, height, width, row_text, on_select=None,
+                 on_end=None):
+        """
+        :param function row_text: Return the text of the row of an index
+        :param function on_select: Called with the index of the row selected
+        :param function on_end: Called when the last row is shown
+        """
+        super(VirtualList, self).__init__(parent)
+        self.rows = 0
+        self.top = 0
+        self.selected = None
+        self.height = height
+        self._row_text = row_text
+        self._on_select = on_select
+        self._on_end = on_end
+
+        self.listbox = Tk.Listbox(self, height=height, width=width, exportselection=False)
+        self.listbox.grid(row=0, column=0, sticky='we')
+        self.scrollbar = Tk.Scrollbar(self, command=self.scroll)
+        self.scrollbar.grid(row=0, column=1, sticky='nsew')
+        self.listbox.bind('<<ListboxSelect>>', self._select)
+        self.listbox.bind('<MouseWheel>', lambda e: self.scroll('scroll', -1 if e.delta > 0 else 1, 'units'))
+        self.listbox.bind('<Button-4>', lambda e: self.scroll('scroll', -1, 'units'))
+        self.listbox.bind('<Button-5>', lambda e: self.scroll('scroll', 1, 'units'))
+        # the list box only has the visible rows, so it cannot move past them
+        self.listbox.bind('<Up>', lambda e: self._move(-1))
+        self.listbox.bind('<Down>', lambda e: self._move(1))
+        self.listbox.bind('<Prior>', lambda e: self._move(-self.height))
+        self.listbox.bind('<Next>', lambda e: self._move(self.height))
+
+    def set_state(self, state):
+        self.listbox.config(state=state)
+
+    def set_rows(self, rows, top=None):
+        """Set the number of rows and show them again, from the top row given
+        (or the current one)"""
+        self.rows = rows
+        if self.selected is not None and self.selected >= rows:
+            self.selected = None
+        self._show(self.top if top is None else top)
+
+    def update_row(self, index):
+        """Show the row of the index again, if it is visible"""
+        if self.top <= index < self.top + self.height and index < self.rows:
+            # rows cannot be changed in a disabled list box
+            state = self.listbox.cget('state')
+            self.listbox.config(state=Tk.NORMAL)
+            self.listbox.delete(index - self.top)
+            self.listbox.insert(index - self.top, self._row_text(index))
+            if index == self.selected:
+                self.listbox.selection_set(index - self.top)
+            self.listbox.config(state=state)
+
+    def select(self, index):
+        """Select the row of the index, scrolling to it if needed"""
+        self.selected = index
+        if index is not None and index < self.top:
+            self._show(index)
+        elif index is not None and index >= self.top + self.height:
+            self._show(index - self.height + 1)
+        else:
+            self._show(self.top)
+
+    def scroll(self, *args):
+        """Handle the commands of the scroll bar (and mouse wheel)"""
+        if args[0] == 'moveto':
+            top = int(round(float(args[1]) * self.rows))
+        elif args[2] == 'pages':
+            top = self.top + int(args[1]) * self.height
+        else:
+            top = self.top + int(args[1])
+        self._show(top)
+
+    def _show(self, top):
+        self.top = max(0, min(top, self.rows - self.height))
+        last = min(self.top + self.height, self.rows)
+        state = self.listbox.cget('state')
+        self.listbox.config(state=Tk.NORMAL)
+        self.listbox.delete(0, Tk.END)
+        for index in xrange(self.top, last):
+            self.listbox.insert(Tk.END, self._row_text(index))
+        if self.selected is not None and self.top <= self.selected < last:
+            self.listbox.selection_set(self.selected - self.top)
+            self.listbox.activate(self.selected - self.top)
+        self.listbox.config(state=state)
+        if self.rows:
+            self.scrollbar.set(float(self.top) / self.rows, float(last) / self.rows)
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        if self._on_end and last == self.rows:
+            self.after_idle(self._on_end)
+
+    def _move(self, offset):
+        """Select the row at the offset from the one selected (or the top
+        one), as the keys of the list box would"""
+        if self.listbox.cget('state') != Tk.DISABLED and self.rows:
+            if self.selected is None:
+                index = self.top
+            else:
+                index = max(0, min(self.selected + offset, self.rows - 1))
+            if index != self.selected:
+                self.select(index)
+                if self._on_select:
+                    self._on_select(index)
+        # the default bindings would select rows of the list box again
+        return 'break'
+
+    def _select(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.selected = self.top + int(selection[0])
+            if self._on_select:
+                self._on_select(self.selected)
+
+
 class Gui:
     def __init__(self):
         self.client = Client()
@@ -519,19 +673,25 @@ class CreationTab(Tk.Frame, object):
             ephemeral = None
         if self.check_gen_hsub.var.get():
             hsub = None
+        # the key is generated and the nym created in the background
+        self.set_interface(False)
+        job = self.client.jobs.submit(self.client.send_create, name,
+                                      duration, ephemeral, hsub)
+        when_done(self, job, self.show_created_nym)
+
+    def show_created_nym(self, job):
         try:
-            success, info, ciphertext = self.client.send_create(name,
-                                                                duration,
-                                                                ephemeral,
-                                                                hsub)
+            success, info, ciphertext = job.result()
         except errors.NymphemeralError as e:
             tkMessageBox.showerror(e.title, e.message)
+            self.set_interface(True)
         else:
-            write_on_text(self.text_create, [info, ciphertext])
+            write_sent_message(self.client, self.text_create, info, ciphertext)
             if success:
                 self.gui.window_main.update_nym_info()
-                self.set_interface(False)
                 self.gui.window_main.set_creation_interface(False)
+            else:
+                self.set_interface(True)
 
 
 class InboxTab(Tk.Frame, object):
@@ -543,7 +703,15 @@ class InboxTab(Tk.Frame, object):
         self.tab_send = tab_send
         self.tab_unread = tab_unread
         self.messages = None
+        self.all_messages_loaded = None
+        # the sort key of the last stored message loaded, older ones follow it
+        self.messages_cursor = None
         self.current_message_index = None
+        self.retrieval_events = None
+        self.retrieval_error = None
+        # unread messages being decrypted in the background
+        self.decrypting_messages = []
+        self.decrypting_all_messages = False
 
         frame_tab = Tk.Frame(self)
         frame_tab.grid(sticky='nswe', padx=15, pady=15)
@@ -556,18 +724,23 @@ class InboxTab(Tk.Frame, object):
                                             command=self.start_retrieving_messages)
         self.button_aampy_inbox.grid(row=0, sticky='w')
 
+        # decrypt all button
+        self.button_decrypt_all_inbox = Tk.Button(frame_retrieve, width=14, text='Decrypt All',
+                                                  command=self.decrypt_unread_messages)
+        self.button_decrypt_all_inbox.grid(row=0, column=1, sticky='w', padx=(15, 0))
+
         # progress bar
         self.progress_bar_inbox = ttk.Progressbar(frame_retrieve, mode='indeterminate', length=427)
 
         # messages list box
         frame_list = Tk.LabelFrame(frame_tab, text='Messages')
         frame_list.grid(sticky='we')
-        self.list_messages_inbox = Tk.Listbox(frame_list, height=11, width=70)
+        # only the titles of the visible messages are in the list box
+        self.list_messages_inbox = VirtualList(frame_list, height=11, width=70,
+                                               row_text=lambda index: self.messages[index].title,
+                                               on_select=self.select_message,
+                                               on_end=self.load_more_messages)
         self.list_messages_inbox.grid(row=0, column=0, sticky='we')
-        scrollbar_list = Tk.Scrollbar(frame_list, command=self.list_messages_inbox.yview)
-        scrollbar_list.grid(row=0, column=1, sticky='nsew')
-        self.list_messages_inbox['yscrollcommand'] = scrollbar_list.set
-        self.list_messages_inbox.bind('<<ListboxSelect>>', self.select_message)
 
         # message contents
         frame_content = Tk.Frame(frame_tab)
@@ -614,123 +787,253 @@ class InboxTab(Tk.Frame, object):
 
     def update_messages_list(self):
         self.toggle_interface(False)
-        self.list_messages_inbox.delete(0, Tk.END)
-        for m in self.messages:
-            self.list_messages_inbox.insert(Tk.END, m.title)
+        self.list_messages_inbox.set_rows(len(self.messages), top=0)
+        self.list_messages_inbox.select(self.current_message_index)
         try:
             self.tab_unread.update_unread_counter()
         except AttributeError:
             pass
 
     def load_messages(self):
-        self.messages = self.client.retrieve_messages_from_disk()
+        # only the newest messages are loaded, older ones are loaded on scroll
+        self.messages = list(self.client.iter_messages(limit=MESSAGES_PAGE_SIZE))
+        self.all_messages_loaded = len(self.messages) < MESSAGES_PAGE_SIZE
+        self.messages_cursor = self.messages[-1].sort_key if self.messages else None
         self.current_message_index = None
         self.update_messages_list()
 
+    def load_more_messages(self):
+        if self.all_messages_loaded:
+            return
+        # the page follows the last message loaded instead of the number of
+        # messages in the list, which changes when messages are saved or deleted
+        page = list(self.client.iter_messages(after=self.messages_cursor, limit=MESSAGES_PAGE_SIZE))
+        self.all_messages_loaded = len(page) < MESSAGES_PAGE_SIZE
+        if page:
+            self.messages_cursor = page[-1].sort_key
+        loaded = set(m.identifier for m in self.messages if m.identifier is not None)
+        self.messages.extend(m for m in page if m.identifier not in loaded)
+        self.list_messages_inbox.set_rows(len(self.messages))
+
     def start_retrieving_messages(self):
+        self.retrieval_events = self.client.aampy.subscribe()
+        self.retrieval_error = None
         self.client.start_aampy()
-        self.wait_for_retrieval()
         self.toggle_interface(True)
+        self.wait_for_retrieval()
 
     def stop_retrieving_messages(self):
         self.client.stop_aampy()
+        self.finish_retrieval()
+
+    def finish_retrieval(self):
+        if self.retrieval_events:
+            self.client.aampy.unsubscribe(self.retrieval_events)
+            self.retrieval_events = None
         self.toggle_interface(False)
+        try:
+            self.tab_unread.update_unread_counter()
+        except AttributeError:
+            pass
 
     def wait_for_retrieval(self):
-        if self.client.aampy.is_running is False:
-            self.gui.window_main.id_after = None
-            if self.client.aampy.server_found:
-                self.load_messages()
-            else:
-                self.toggle_interface(False)
+        # the events are published by the threads of aampy and handled here,
+        # by the main loop
+        self.gui.window_main.id_after = None
+        try:
+            while True:
+                if not self.handle_retrieval_event(self.retrieval_events.get_nowait()):
+                    return
+        except Empty:
+            pass
+        self.gui.window_main.id_after = self.gui.window_main.after(RETRIEVAL_EVENTS_INTERVAL,
+                                                                   self.wait_for_retrieval)
+
+    def handle_retrieval_event(self, event):
+        """Update the interface with an event of the retrieval. Return whether
+        the retrieval is still running"""
+        if event.kind == PROGRESS:
+            self.progress_bar_inbox.stop()
+            self.progress_bar_inbox.config(mode='determinate', value=int(event.data['ratio'] * 100))
+        elif event.kind == MESSAGE:
+            if event.data['nick'] == self.client.nym_address:
+                self.add_new_message(event.data['file_name'])
+            try:
+                self.tab_unread.update_unread_counter()
+            except AttributeError:
+                pass
+        elif event.kind == ERROR:
+            self.retrieval_error = event.data['error']
+        elif event.kind == FINISHED:
+            self.finish_retrieval()
+            if not event.data['server_found']:
                 tkMessageBox.showerror('Socket Error', 'The news server cannot be found!')
-        else:
-            if self.client.aampy.progress_ratio is not None:
-                self.progress_bar_inbox.stop()
-                self.progress_bar_inbox.config(mode='determinate', value=int(self.client.aampy.progress_ratio * 100))
-            self.gui.window_main.id_after = self.gui.window_main.after(1000, lambda: self.wait_for_retrieval())
+            elif not event.data['completed'] and self.retrieval_error:
+                tkMessageBox.showerror('Retrieval Error',
+                                       'The retrieval was interrupted: ' + self.retrieval_error)
+            return False
+        return True
+
+    def add_new_message(self, file_name):
+        """Add a message found by the retrieval to the top of the list"""
+        msg = self.client.retrieve_unread_message(file_name)
+        if msg is None or msg.identifier in [m.identifier for m in self.messages]:
+            return
+        self.messages.insert(0, msg)
+        if self.current_message_index is not None:
+            self.current_message_index += 1
+            self.list_messages_inbox.selected = self.current_message_index
+        self.list_messages_inbox.set_rows(len(self.messages))
 
     def toggle_interface(self, retrieving_messages):
         self.button_save_del_inbox.config(state=Tk.DISABLED)
         self.button_reply_inbox.config(state=Tk.DISABLED)
         if retrieving_messages:
-            self.list_messages_inbox.config(state=Tk.DISABLED)
+            self.list_messages_inbox.set_state(Tk.DISABLED)
+            self.button_decrypt_all_inbox.grid_forget()
             self.progress_bar_inbox.grid(row=0, column=1, sticky='nswe', padx=(15, 0))
             self.progress_bar_inbox.config(mode='indeterminate')
             self.progress_bar_inbox.start(25)
             self.button_aampy_inbox.config(text='Stop', command=self.stop_retrieving_messages)
         else:
-            self.list_messages_inbox.config(state=Tk.NORMAL)
+            self.list_messages_inbox.set_state(Tk.NORMAL)
             self.progress_bar_inbox.stop()
             self.progress_bar_inbox.grid_forget()
+            self.button_decrypt_all_inbox.grid(row=0, column=1, sticky='w', padx=(15, 0))
             self.button_aampy_inbox.config(text='Retrieve Messages', command=self.start_retrieving_messages)
 
-    def decrypt_e2ee_message(self, msg):
+    def decrypt_e2ee_message(self, msg, callback):
+        """Decrypt the end-to-end encryption layer of the message (if any) in
+        the background, asking for a passphrase first if needed, then call
+        the callback with the resulting message"""
         pgp_message = search_pgp_message(msg.content)
-        if pgp_message:
-            if self.client.use_agent:
-                return self.client.decrypt_e2ee_message(msg)
+        passphrase = None
+        if not pgp_message:
+            callback(msg)
+            return
+        if not self.client.use_agent:
+            keyids = retrieve_keyids(pgp_message)
+            keys = []
+            if keyids:
+                for k in keyids:
+                    try:
+                        keys.append(retrieve_key(self.client.keyring, k))
+                    except errors.KeyNotFoundError:
+                        pass
+            if keys:
+                prompt = 'Message encrypted to:' + LINESEP
+                for k in keys:
+                    prompt += format_key_info(k)
             else:
-                keyids = retrieve_keyids(pgp_message)
-                keys = []
-                if keyids:
-                    for k in keyids:
-                        try:
-                            keys.append(retrieve_key(self.client.gpg, k))
-                        except errors.KeyNotFoundError:
-                            pass
-                if keys:
-                    prompt = 'Message encrypted to:' + LINESEP
-                    for k in keys:
-                        prompt += format_key_info(k)
-                else:
-                    prompt = ('The key ID which the message was encrypted to '
-                              'was removed or is not in the keyring.' +
-                              LINESEP)
-                prompt += 'Provide a passphrase to attempt to decrypt it:'
-                passphrase = tkSimpleDialog.askstring('End-to-End Encrypted Message',
-                                                      prompt,
-                                                      parent=self,
-                                                      show='*')
-                if passphrase is None:
-                    return msg
-                else:
-                    return self.client.decrypt_e2ee_message(msg, passphrase)
+                prompt = ('The key ID which the message was encrypted to '
+                          'was removed or is not in the keyring.' +
+                          LINESEP)
+            prompt += 'Provide a passphrase to attempt to decrypt it:'
+            passphrase = tkSimpleDialog.askstring('End-to-End Encrypted Message',
+                                                  prompt,
+                                                  parent=self,
+                                                  show='*')
+            if passphrase is None:
+                callback(msg)
+                return
+
+        def done(job):
+            try:
+                callback(job.result())
+            except errors.UndecipherableMessageError:
+                callback(msg)
+        when_done(self, self.client.jobs.submit(self.client.decrypt_e2ee_message, msg, passphrase), done)
+
+    def replace_message(self, index, msg):
+        """Replace a message of the list with its decrypted message"""
+        if index is None:
+            # decrypted messages are not stored, so the ones that were not
+            # loaded yet are added to the list
+            self.messages.append(msg)
+            self.list_messages_inbox.set_rows(len(self.messages))
         else:
-            return msg
+            self.messages[index] = msg
+            self.list_messages_inbox.update_row(index)
+        try:
+            self.tab_unread.update_unread_counter()
+        except AttributeError:
+            pass
+
+    def decrypt_unread_messages(self):
+        if self.client.aampy.is_running or self.decrypting_all_messages:
+            return
+        self.decrypting_all_messages = True
+        self.button_decrypt_all_inbox.config(state=Tk.DISABLED)
+        when_done(self, self.client.jobs.submit(self.client.decrypt_unread_messages), self.show_unread_messages)
 
-    def select_message(self, event):
+    def show_unread_messages(self, job):
+        self.decrypting_all_messages = False
+        self.button_decrypt_all_inbox.config(state=Tk.NORMAL)
+        try:
+            results = job.result()
+        except errors.NymphemeralError as e:
+            tkMessageBox.showerror(e.title, e.message)
+            return
+        failed = 0
+        for identifier, decrypted in results:
+            if decrypted is None:
+                failed += 1
+                continue
+
+            def replace(msg, identifier=identifier):
+                indexes = [i for i, m in enumerate(self.messages) if m.identifier == identifier]
+                self.replace_message(indexes[0] if indexes else None, msg)
+
+            # Check for and decrypt an end-to-end encryption layer
+            self.decrypt_e2ee_message(decrypted, replace)
+        if failed:
+            e = errors.UndecipherableMessageError()
+            tkMessageBox.showerror(e.title, str(failed) + ' message(s) could not be decrypted.')
+
+    def select_message(self, index):
         if len(self.messages) and not self.client.aampy.is_running:
-            index = int(event.widget.curselection()[0])
             self.current_message_index = index
+            msg = self.messages[index]
 
-            if self.messages[index].is_unread:
+            if msg.is_unread:
                 self.button_save_del_inbox.config(state=Tk.DISABLED)
                 self.button_reply_inbox.config(state=Tk.DISABLED)
-
-                try:
-                    self.messages[index] = self.client.decrypt_ephemeral_message(self.messages[index])
-                except errors.UndecipherableMessageError as e:
-                    tkMessageBox.showerror(e.title, e.message)
-                    self.messages.pop(index)
-                    self.current_message_index = None
-                    self.update_messages_list()
-                else:
-                    # Check for and decrypt an end-to-end encryption layer
-                    try:
-                        self.messages[index] = self.decrypt_e2ee_message(self.messages[index])
-                    except errors.UndecipherableMessageError:
-                        pass
-
-                    self.update_messages_list()
-                    self.display_message(self.messages[index])
+                # the decryption runs in the background, once
+                if self.decrypting_all_messages or msg in self.decrypting_messages:
+                    return
+                self.decrypting_messages.append(msg)
+                when_done(self, self.client.jobs.submit(self.client.decrypt_ephemeral_message, msg),
+                          lambda job: self.show_unread_message(msg, job))
             else:
-                self.display_message(self.messages[index])
+                self.display_message(msg)
+
+    def show_unread_message(self, msg, job):
+        self.decrypting_messages.remove(msg)
+        try:
+            decrypted = job.result()
+        except errors.UndecipherableMessageError as e:
+            tkMessageBox.showerror(e.title, e.message)
+            # the message is kept, so that it can be deleted
+            if self.current_message_index is not None and self.messages[self.current_message_index] is msg:
+                self.display_message(msg)
+            return
+
+        def show(decrypted):
+            if msg not in self.messages:
+                return
+            index = self.messages.index(msg)
+            self.replace_message(index, decrypted)
+            if index == self.current_message_index:
+                self.display_message(decrypted)
+
+        # Check for and decrypt an end-to-end encryption layer
+        self.decrypt_e2ee_message(decrypted, show)
 
     def display_message(self, msg):
         write_on_text(self.text_headers_inbox, [msg.headers])
         write_on_text(self.text_body_inbox, [msg.content])
-        if os.path.exists(msg.identifier):
+        # messages that are not stored were decrypted but not saved
+        if msg.identifier is not None:
             self.toggle_save_del_button(False)
         else:
             self.toggle_save_del_button(True)
@@ -744,14 +1047,25 @@ class InboxTab(Tk.Frame, object):
             self.button_save_del_inbox.config(text='Delete from Disk', command=self.delete_and_update_interface)
 
     def save_and_update_interface(self):
-        if self.client.save_message_to_disk(self.messages[self.current_message_index]):
-            self.toggle_save_del_button(False)
-            self.show_label_save_del('Message saved')
+        self.button_save_del_inbox.config(state=Tk.DISABLED)
+        msg = self.messages[self.current_message_index]
+        when_done(self, self.client.jobs.submit(self.client.save_message_to_disk, msg),
+                  lambda job: self.update_save_del_interface(msg, job, saved=True))
 
     def delete_and_update_interface(self):
-        if self.client.delete_message_from_disk(self.messages[self.current_message_index]):
-            self.toggle_save_del_button(True)
-            self.show_label_save_del('Message deleted')
+        self.button_save_del_inbox.config(state=Tk.DISABLED)
+        msg = self.messages[self.current_message_index]
+        when_done(self, self.client.jobs.submit(self.client.delete_message_from_disk, msg),
+                  lambda job: self.update_save_del_interface(msg, job, saved=False))
+
+    def update_save_del_interface(self, msg, job, saved):
+        # the user may have selected another message in the meantime
+        if self.current_message_index is None or self.messages[self.current_message_index] is not msg:
+            return
+        self.button_save_del_inbox.config(state=Tk.NORMAL)
+        if job.result():
+            self.toggle_save_del_button(not saved)
+            self.show_label_save_del('Message saved' if saved else 'Message deleted')
 
     def show_label_save_del(self, text):
         self.label_save_del_inbox.config(text=text)
@@ -866,7 +1180,7 @@ class SendTab(Tk.Frame, object):
             # if signing, nymphemeral's own dialog will prompt for a passphrase
             # in case the user chose not to use the GPG agent
             if e2ee_signer and not self.client.use_agent:
-                e2ee_signer_key = retrieve_key(self.client.gpg, e2ee_signer)
+                e2ee_signer_key = retrieve_key(self.client.keyring, e2ee_signer)
                 prompt = (
                     'Signing with:' + LINESEP +
                     format_key_info(e2ee_signer_key) +
@@ -881,20 +1195,28 @@ class SendTab(Tk.Frame, object):
                 if passphrase is None:
                     # the user has canceled
                     return
-            success, info, ciphertext = self.client.send_message(
-                target_address,
-                body,
-                subject,
-                headers,
-                e2ee_target,
-                e2ee_signer,
-                passphrase,
-                throw_keyids
-            )
+        except errors.NymphemeralError as e:
+            tkMessageBox.showerror(e.title, e.message)
+            return
+        # the message is encrypted and sent in the background
+        job = self.client.jobs.submit(self.client.send_message,
+                                      target_address,
+                                      body,
+                                      subject,
+                                      headers,
+                                      e2ee_target,
+                                      e2ee_signer,
+                                      passphrase,
+                                      throw_keyids)
+        when_done(self, job, self.show_sent_message)
+
+    def show_sent_message(self, job):
+        try:
+            success, info, ciphertext = job.result()
         except errors.NymphemeralError as e:
             tkMessageBox.showerror(e.title, e.message)
         else:
-            write_on_text(self.text_body, [info, ciphertext])
+            write_sent_message(self.client, self.text_body, info, ciphertext)
 
 
 class ConfigTab(Tk.Frame, object):
@@ -981,22 +1303,39 @@ class ConfigTab(Tk.Frame, object):
         if tkMessageBox.askyesno('Confirm',
                                  'Are you sure you want to reconfigure the '
                                  'nym?'):
-            try:
-                success, info, ciphertext = self.client.send_config(
-                    ephemeral,
-                    hsub,
-                    name,
-                    gen_ephemeral=self.check_gen_ephemeral.var.get(),
-                    gen_hsub=self.check_gen_hsub.var.get())
-            except errors.EmptyChangesError as e:
-                tkMessageBox.showerror(e.title, e.message)
-            else:
-                write_on_text(self.text_config, [info, ciphertext])
+            # the conversation state is only replaced after the jobs
+            # submitted before
+            job = self.client.jobs.submit(
+                self.client.send_config,
+                ephemeral,
+                hsub,
+                name,
+                gen_ephemeral=self.check_gen_ephemeral.var.get(),
+                gen_hsub=self.check_gen_hsub.var.get())
+            when_done(self, job, self.show_config_message)
+
+    def show_config_message(self, job):
+        try:
+            success, info, ciphertext = job.result()
+        except errors.NymphemeralError as e:
+            tkMessageBox.showerror(e.title, e.message)
+        else:
+            write_sent_message(self.client, self.text_config, info,
+                               ciphertext)
 
     def send_delete(self):
         if tkMessageBox.askyesno('Confirm', 'Are you sure you want to delete the nym?'):
-            success, info, ciphertext = self.client.send_delete()
-            write_on_text(self.text_config, [info, ciphertext])
+            when_done(self, self.client.jobs.submit(self.client.send_delete),
+                      self.show_delete_message)
+
+    def show_delete_message(self, job):
+        try:
+            success, info, ciphertext = job.result()
+        except errors.NymphemeralError as e:
+            tkMessageBox.showerror(e.title, e.message)
+        else:
+            write_sent_message(self.client, self.text_config, info,
+                               ciphertext)
             if success:
                 self.set_deleted_interface()
 
@@ -1035,7 +1374,10 @@ class UnreadCounterTab(Tk.Frame, object):
 
 
 def main():
-    Gui().window_login.mainloop()
+    gui = Gui()
+    gui.window_login.mainloop()
+    # the conversation state is kept in memory until the session ends
+    gui.client.close()
 
 
 if __name__ == '__main__':
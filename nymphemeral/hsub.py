@@ -15,12 +15,16 @@
 # or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
 # for more details.
 
+from binascii import unhexlify
 from hashlib import sha256
+from multiprocessing import cpu_count, Pool
 from os import urandom
 
 
 MINIMUM_LENGTH = 48
 MAXIMUM_LENGTH = 80
+IV_DIGITS = 16
+HEX_DIGITS = '0123456789abcdef'
 
 
 def hash(text, iv = None, hsublen = MINIMUM_LENGTH):
@@ -68,6 +72,123 @@ def hexiv(hsub, digits = 16):
         return False
     return iv
 
+class HsubMatcher(object):
+    """Match subjects against the hSubs of several passphrases at once.
+
+    Built once from the passphrases (indexed by nickname), it checks each
+    subject by decoding it and its IV a single time, hashing the IV once
+    and reusing that hash object for every passphrase, and comparing raw
+    digest prefixes instead of hex encoded strings."""
+
+    def __init__(self, passphrases):
+        self._passphrases = [(nick, str(passphrase))
+                             for nick, passphrase in passphrases.items()]
+
+    def match_subject(self, subject):
+        """Return the nicknames whose hSubs collide with the subject."""
+        nicks = []
+        if not self._passphrases or not subject:
+            return nicks
+        hsublen = len(subject)
+        if hsublen < MINIMUM_LENGTH or hsublen > MAXIMUM_LENGTH:
+            return nicks
+        # hash() only generates lower case hex digits
+        if subject.translate(None, HEX_DIGITS):
+            return nicks
+        digest_digits = hsublen - IV_DIGITS
+        iv = unhexlify(subject[:IV_DIGITS])
+        prefix = unhexlify(subject[IV_DIGITS:hsublen - digest_digits % 2])
+        prefix_length = len(prefix)
+        # the last hex digit of odd length hSubs is half a byte
+        nibble = None
+        if digest_digits % 2:
+            nibble = HEX_DIGITS.index(subject[-1])
+        iv_hash = sha256(iv)
+        for nick, passphrase in self._passphrases:
+            h = iv_hash.copy()
+            h.update(passphrase)
+            digest = h.digest()
+            if digest[:prefix_length] == prefix:
+                if nibble is None or ord(digest[prefix_length]) >> 4 == nibble:
+                    nicks.append(nick)
+        return nicks
+
+    def match(self, subjects):
+        """Match a batch of subjects. Expects an iterable of (key, subject)
+        and returns a list of (key, nickname) for every collision."""
+        matches = []
+        for key, subject in subjects:
+            for nick in self.match_subject(subject):
+                matches.append((key, nick))
+        return matches
+
+    def match_async(self, subjects):
+        """Same as match(), but returns an object whose get() method returns
+        the matches, as HsubPool does. The batch is matched right away."""
+        return Matches(matches=self.match(subjects))
+
+    def close(self):
+        pass
+
+class Matches(object):
+    """The matches of a batch of subjects. Parts of the batch might still be
+    matched by other processes, whose results are waited for by get()."""
+
+    def __init__(self, matches=None, results=None):
+        self._matches = matches or []
+        self._results = results or []
+
+    def get(self):
+        for result in self._results:
+            self._matches += result.get()
+        self._results = []
+        return self._matches
+
+# the matcher of each process of an HsubPool
+_worker_matcher = None
+
+def _initialize_worker(passphrases):
+    global _worker_matcher
+    _worker_matcher = HsubMatcher(passphrases)
+
+def _match_in_worker(subjects):
+    return _worker_matcher.match(subjects)
+
+class HsubPool(object):
+    """Match batches of subjects in a pool of processes, so that hashing is
+    not bound to a single core. Batches are split among the processes and
+    matched asynchronously, letting the caller keep downloading subjects
+    meanwhile. It must be closed after being used."""
+
+    def __init__(self, passphrases, processes=None):
+        if processes is None:
+            processes = cpu_count()
+        self._processes = processes
+        self._matcher = HsubMatcher(passphrases)
+        self._pool = Pool(processes, _initialize_worker, (passphrases,))
+
+    def match_subject(self, subject):
+        """Match a single subject in this process."""
+        return self._matcher.match_subject(subject)
+
+    def match(self, subjects):
+        return self.match_async(subjects).get()
+
+    def match_async(self, subjects):
+        """Split the batch among the processes. Returns an object whose get()
+        method waits for and returns the matches."""
+        subjects = list(subjects)
+        size = -(-len(subjects) // self._processes)
+        results = []
+        for i in xrange(0, len(subjects), size or 1):
+            results.append(self._pool.apply_async(_match_in_worker,
+                                                  (subjects[i:i + size],)))
+        return Matches(results=results)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
 def main():
     """Only used for testing purposes.  We Generate an hSub and then check it
     using the same input text."""
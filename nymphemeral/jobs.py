@@ -0,0 +1,88 @@
+import logging
+import sys
+from Queue import Queue
+from threading import Event, Thread
+
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+    """A call submitted to a JobExecutor, whose result (or exception) is
+    available when it is done, like a future"""
+    def __init__(self, function, args, kwargs):
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+        self._done = Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Return the result of the call, waiting for it to be done, or raise
+        the exception it raised"""
+        self.exception(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the exception raised by the call (or None), waiting for it
+        to be done"""
+        if not self._done.wait(timeout):
+            raise RuntimeError('The job is not done')
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def _run(self):
+        try:
+            self._result = self._function(*self._args, **self._kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+
+class JobExecutor(object):
+    """Run the jobs submitted (such as decryptions, encryptions and
+    deliveries of messages) in background threads, in the order they were
+    submitted, so that the GUI does not wait for them"""
+    def __init__(self, workers=1):
+        self._queue = Queue()
+        self._threads = []
+        for _ in xrange(workers):
+            thread = Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        log.debug('Initialized')
+
+    def _work(self):
+        for job in iter(self._queue.get, None):
+            job._run()
+            self._queue.task_done()
+
+    def submit(self, function, *args, **kwargs):
+        """Run the function with the arguments in the background
+
+        :rtype: Job
+        """
+        job = Job(function, args, kwargs)
+        self._queue.put(job)
+        return job
+
+    def join(self):
+        """Wait until the jobs already submitted are done"""
+        self._queue.join()
+
+    def shutdown(self, wait=True):
+        """Stop the threads after the jobs already submitted are done"""
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -1 +1,2 @@
+from .index import KeyringIndex
 from .keys import read_default_keys
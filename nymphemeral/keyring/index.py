@@ -0,0 +1,163 @@
+import os
+import re
+from threading import Lock
+
+
+# files and directories of the GPG home that change with the keyring
+KEYRING_FILES = [
+    'pubring.gpg',
+    'pubring.kbx',
+    'secring.gpg',
+    'private-keys-v1.d',
+]
+
+# shorter suffixes of fingerprints and key IDs are not indexed
+MINIMUM_SUFFIX_LENGTH = 8
+
+
+def uid_emails(uid):
+    """Return the email addresses found in a user ID"""
+    return re.findall(r'\b\S+@\S+\b', uid)
+
+
+def uid_tokens(uid):
+    """Return the (lower case) words of a user ID"""
+    return re.findall(r'\w+', uid.lower())
+
+
+def suffixes(key_id):
+    """Return the (lower case) suffixes of a fingerprint or key ID that are
+    long enough to be indexed"""
+    key_id = key_id.lower()
+    return [key_id[-length:]
+            for length in xrange(MINIMUM_SUFFIX_LENGTH, len(key_id) + 1)]
+
+
+class KeyringIndex(object):
+    """An index of the keys in a keyring, so that searches do not have to
+    list the keys with gpg every time
+
+    The index is built when it is first used and rebuilt after it is
+    invalidated (when the client changes the keyring) or the keyring files
+    are modified by something else
+    """
+    def __init__(self, gpg, home):
+        """
+        :param gpg: The object used to list the keys
+        :type gpg: gnupg.GPG
+        :param str home: The GPG home directory of the keyring
+        """
+        self._gpg = gpg
+        self._paths = [os.path.join(home, f) for f in KEYRING_FILES]
+        self._stamp = None
+        self._lock = Lock()
+
+        self._keys = []
+        self._secret_keys = {}
+        self._by_suffix = {}
+        self._by_token = {}
+        self._servers = {}
+
+    def _keyring_stamp(self):
+        stamp = []
+        for path in self._paths:
+            try:
+                info = os.stat(path)
+            except OSError:
+                stamp.append(None)
+            else:
+                stamp.append((info.st_mtime, info.st_size))
+        return tuple(stamp)
+
+    def _build(self):
+        self._keys = self._gpg.list_keys()
+        self._secret_keys = self._gpg.list_keys(secret=True).key_map
+        self._by_suffix = {}
+        self._by_token = {}
+        self._servers = {}
+        for key in self._keys:
+            fingerprint = key['fingerprint']
+            # the key ID of the key is a suffix of its fingerprint
+            key_suffixes = set(suffixes(fingerprint))
+            for sub in key['subkeys']:
+                key_suffixes.update(suffixes(sub[0]))
+            for suffix in key_suffixes:
+                self._by_suffix.setdefault(suffix, []).append(key)
+            tokens = set()
+            domains = {}
+            for uid in key['uids']:
+                tokens.update(uid_tokens(uid))
+                for email in uid_emails(uid):
+                    local, domain = email.split('@', 1)
+                    domains.setdefault(local.lower(), domain)
+            # nym servers have config, send and url addresses
+            if 'config' in domains and 'send' in domains and 'url' in domains:
+                self._servers[domains['config']] = fingerprint
+            for token in tokens:
+                self._by_token.setdefault(token, []).append(key)
+
+    def _update(self):
+        stamp = self._keyring_stamp()
+        with self._lock:
+            if stamp != self._stamp:
+                self._build()
+                self._stamp = stamp
+
+    def invalidate(self):
+        """Rebuild the index the next time it is used. Should be called after
+        the keyring is modified"""
+        with self._lock:
+            self._stamp = None
+
+    @property
+    def secret_keys(self):
+        """The secret keys indexed by fingerprints of keys and subkeys, as
+        gpg.list_keys(secret=True).key_map"""
+        self._update()
+        return self._secret_keys
+
+    @property
+    def servers(self):
+        """The fingerprints of the nym servers indexed by their domains"""
+        self._update()
+        return self._servers
+
+    def search(self, search_query):
+        """Return the public keys whose fingerprints, key IDs or subkey IDs
+        end with the search query, or that have user IDs with it (as whole
+        words)
+
+        Instead of checking every key, the candidates are looked up by the
+        suffix and by the least common word of the search query
+
+        :param str search_query: The search query
+        :rtype: list
+        """
+        search_query = search_query.lower()
+        self._update()
+        if len(search_query) >= MINIMUM_SUFFIX_LENGTH:
+            results = list(self._by_suffix.get(search_query, []))
+        else:
+            results = [k for k in self._keys
+                       if k['fingerprint'].lower().endswith(search_query) or
+                       any(sub[0].lower().endswith(search_query)
+                           for sub in k['subkeys'])]
+
+        # every word of the search query is a word of the user IDs it matches
+        tokens = uid_tokens(search_query)
+        if tokens:
+            candidates = min((self._by_token.get(t, []) for t in tokens),
+                             key=len)
+        else:
+            candidates = self._keys
+        pattern = re.compile(r'\b' + re.escape(search_query) + r'\b',
+                             flags=re.IGNORECASE)
+        found = set(k['fingerprint'] for k in results)
+        for key in candidates:
+            if key['fingerprint'] not in found:
+                for uid in key['uids']:
+                    if pattern.search(uid):
+                        results.append(key)
+                        found.add(key['fingerprint'])
+                        break
+        return results
@@ -7,44 +7,84 @@ from . import LINESEP
 
 
 class Message(object):
-    def __init__(self, is_unread, string, identifier):
+    def __init__(self, is_unread, string, identifier, date=None, sender=None,
+                 subject=None, load=None, sort_key=None):
+        """A message that is processed from the string given or, if the
+        string is None, from the string returned by load() when its content
+        is first needed. In that case, the title is built from the Date
+        header, the address of the sender and the subject given
+
+        :param bool is_unread: Whether the message was not decrypted yet
+        :param str string: The message
+        :param identifier: The ID of the message in the message store, or
+            None if it is not stored
+        :param str date: The Date header of the message
+        :param str sender: The address of the sender
+        :param str subject: The subject of the message
+        :param load: Function that returns the message
+        :param tuple sort_key: The key of the message in the order of the
+            message store, used to read the page that follows it
+        """
         self._subject = None
         self._sender = None
         self._id = None
         self._date = None
         self._headers = None
         self._content = None
-        self._title = None
         self._processed_message = None
+        self._load = load
 
         self.is_unread = is_unread
         self.identifier = identifier
+        self.sort_key = sort_key
 
-        # process the string
-        message = message_from_string(string)
-        title = ''
+        if string is None:
+            self._set_metadata(date, sender, subject)
+        else:
+            self._process(string)
 
-        self._id = message.get('Message-ID')
+    def _set_metadata(self, date, sender, subject):
+        if date:
+            self._date = parser.parse(date)
+        self._sender = sender
+        self._subject = subject
 
-        if 'Date' in message:
-            self._date = parser.parse(message.get('Date'))
+    @property
+    def title(self):
+        # built when needed, as only the titles of the messages shown by the
+        # inbox are needed
+        title = ''
+        if self._date:
             title += str(self._date)[:16] + ' '
-
-        if 'From' in message:
-            sender = message.get('From')
-            address = re.search(r'\b\S+@\S+\b', sender)
-            if address:
-                self._sender = address.group(0)
-                title += self._sender + ': '
-        if not self._sender:
+        if self._sender:
+            title += self._sender + ': '
+        else:
             title = 'Unknown sender: '
-
-        if 'Subject' in message:
-            self._subject = message.get('Subject')
+        if self._subject is not None:
             title += self._subject
         else:
             title += '(no subject)'
 
+        if self.is_unread:
+            title = 'Undecrypted message'
+            if self._date:
+                title += ' - ' + str(self._date)
+
+        return title
+
+    def _process(self, string):
+        message = message_from_string(string)
+
+        self._id = message.get('Message-ID')
+
+        sender = None
+        if 'From' in message:
+            address = re.search(r'\b\S+@\S+\b', message.get('From'))
+            if address:
+                sender = address.group(0)
+        self._set_metadata(message.get('Date'), sender,
+                           message.get('Subject'))
+
         headers = []
         for item in message.items():
             headers.append(': '.join(item))
@@ -67,14 +107,15 @@ class Message(object):
                 content = message.get_payload()
         self._content = content
 
-        if self.is_unread:
-            title = 'Undecrypted message'
-            if self._date:
-                title += ' - ' + str(self._date)
-
-        self._title = title
         self._processed_message = message
 
+    def _process_loaded(self):
+        if self._processed_message is None and self._load:
+            string = self._load()
+            if string is not None:
+                self._process(string)
+                self._load = None
+
     @property
     def subject(self):
         return self._subject
@@ -85,6 +126,7 @@ class Message(object):
 
     @property
     def id(self):
+        self._process_loaded()
         return self._id
 
     @property
@@ -93,16 +135,15 @@ class Message(object):
 
     @property
     def headers(self):
+        self._process_loaded()
         return self._headers
 
     @property
     def content(self):
+        self._process_loaded()
         return self._content
 
-    @property
-    def title(self):
-        return self._title
-
     @property
     def processed_message(self):
+        self._process_loaded()
         return self._processed_message
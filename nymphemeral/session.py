@@ -1,5 +1,8 @@
 class Session:
     def __init__(self):
-        self.axolotl = None
+        # conversation state, kept in memory while the nym is logged in
+        self.ratchet = None
+        # key of the envelopes of the messages, derived from the passphrase
+        self.envelope_key = None
         self.hsubs = {}
         self.nym = None
@@ -0,0 +1,232 @@
+import logging
+import sqlite3
+from collections import namedtuple
+from threading import Lock
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    nym TEXT NOT NULL,
+    name TEXT,
+    unread INTEGER NOT NULL,
+    date REAL,
+    date_header TEXT,
+    envelope BLOB,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_nym_date ON messages (nym, date);
+CREATE INDEX IF NOT EXISTS messages_unread_nym ON messages (unread, nym);
+CREATE INDEX IF NOT EXISTS messages_name ON messages (name);
+"""
+
+NEWEST_FIRST = 'desc'
+OLDEST_FIRST = 'asc'
+
+METADATA_COLUMNS = 'id, nym, name, unread, date, date_header, envelope'
+
+
+log = logging.getLogger(__name__)
+
+
+StoredMessage = namedtuple('StoredMessage', METADATA_COLUMNS.split(', '))
+
+
+def sort_key(stored_message):
+    """Return the key of a stored message in the order of the pages of
+    messages"""
+    return stored_message.date, stored_message.id
+
+
+class MessageStore(object):
+    """The messages of every nym, stored in a SQLite database
+
+    The bodies are stored as they are received (unread messages, which are
+    still encrypted with ephemeral encryption) or encrypted by the nym to
+    itself (read messages). The other columns are used to list the messages
+    without touching their bodies. The Date header of unread messages is
+    stored to list them, while the Date header, sender and subject of read
+    messages are only stored in their envelopes, which are encrypted
+    separately from the bodies
+    """
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        # the store is also used by the thread that waits for aampy
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.text_factory = str
+        with self._lock:
+            self._connection.executescript(SCHEMA)
+            self._upgrade()
+
+        log.debug('Initialized')
+
+    def _upgrade(self):
+        """Upgrade the stores created by previous versions"""
+        columns = [row[1] for row in
+                   self._connection.execute('PRAGMA table_info(messages)')]
+        if 'envelope' not in columns:
+            with self._connection:
+                self._connection.execute(
+                    'ALTER TABLE messages ADD COLUMN envelope BLOB')
+        indexes = [row[0] for row in self._connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        if 'messages_sender' in indexes:
+            # the senders and subjects of read messages were stored
+            # unencrypted, and their envelopes are created from the bodies
+            with self._connection:
+                self._connection.execute(
+                    'UPDATE messages SET sender = NULL, subject = NULL')
+                self._connection.execute(
+                    'DROP INDEX IF EXISTS messages_sender')
+                self._connection.execute(
+                    'DROP INDEX IF EXISTS messages_subject')
+
+    def add(self, nym, body, unread, name=None, date=None, date_header=None,
+            envelope=None):
+        """Store a message and return its ID
+
+        :param str nym: The address of the nym that received the message
+        :param str body: The (encrypted) message
+        :param bool unread: Whether the message was not decrypted yet
+        :param str name: The name of the file the message was stored in
+        :param float date: The UTC epoch of the date of the message
+        :param str date_header: The Date header of the message
+        :param str envelope: The encrypted Date header, sender and subject
+        :rtype: int
+        """
+        if envelope is not None:
+            envelope = sqlite3.Binary(envelope)
+        with self._lock:
+            with self._connection:
+                cursor = self._connection.execute(
+                    'INSERT INTO messages (nym, name, unread, date, '
+                    'date_header, envelope, body) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (nym, name, int(unread), date, date_header, envelope,
+                     sqlite3.Binary(body)))
+                return cursor.lastrowid
+
+    def set_envelope(self, message_id, envelope):
+        """Replace the Date header of a message with its envelope"""
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'UPDATE messages SET envelope = ?, date_header = NULL '
+                    'WHERE id = ?',
+                    (sqlite3.Binary(envelope), message_id))
+
+    def contains(self, nym, name, unread):
+        """Return whether a message stored from the file was already added"""
+        with self._lock:
+            cursor = self._connection.execute(
+                'SELECT 1 FROM messages '
+                'WHERE name = ? AND nym = ? AND unread = ? LIMIT 1',
+                (name, nym, int(unread)))
+            return cursor.fetchone() is not None
+
+    def find(self, nym, name, unread):
+        """Return the metadata of the message stored from the file, or None"""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT ' + METADATA_COLUMNS + ' FROM messages '
+                'WHERE name = ? AND nym = ? AND unread = ? LIMIT 1',
+                (name, nym, int(unread))).fetchone()
+        if row is None:
+            return None
+        message = StoredMessage(*row)
+        if message.envelope is not None:
+            message = message._replace(envelope=str(message.envelope))
+        return message
+
+    def messages(self, nym, offset=0, limit=None, order=NEWEST_FIRST,
+                 unread=None, after=None):
+        """Return the metadata of a page of the messages of the nym, sorted by
+        their dates (using the index of the nyms and dates) and followed by
+        the ones without dates
+
+        Pages can start after the sort key of a message (its date and ID),
+        instead of an offset, so that they are not shifted by messages added
+        or deleted before it
+
+        :param str nym: The address of the nym
+        :param int offset: The number of messages skipped
+        :param int limit: The maximum number of messages, or None for all
+        :param str order: NEWEST_FIRST or OLDEST_FIRST
+        :param bool unread: Whether only unread (True) or read (False)
+            messages are returned, or None for both
+        :param tuple after: The sort key of the message the page starts
+            after (see sort_key()), or None
+        :rtype: list
+        """
+        if order not in (NEWEST_FIRST, OLDEST_FIRST):
+            raise ValueError('Invalid order: ' + str(order))
+        if limit is None:
+            limit = -1
+        where = 'nym = ?'
+        parameters = [nym]
+        if unread is not None:
+            where += ' AND unread = ?'
+            parameters.append(int(unread))
+        if after is not None:
+            date, message_id = after
+            if date is None:
+                where += ' AND date IS NULL AND id > ?'
+                parameters.append(message_id)
+            else:
+                where += (' AND (date IS NULL OR date ' +
+                          ('<' if order == NEWEST_FIRST else '>') +
+                          ' ? OR (date = ? AND id > ?))')
+                parameters += [date, date, message_id]
+        with self._lock:
+            cursor = self._connection.execute(
+                'SELECT ' + METADATA_COLUMNS + ' FROM messages '
+                'WHERE ' + where + ' ORDER BY date IS NULL, date ' + order +
+                ', id LIMIT ? OFFSET ?',
+                parameters + [limit, offset])
+            messages = []
+            for row in cursor:
+                message = StoredMessage(*row)
+                if message.envelope is not None:
+                    # blobs are read as buffers
+                    message = message._replace(envelope=str(message.envelope))
+                messages.append(message)
+            return messages
+
+    def data_version(self):
+        """Return a number that changes whenever another connection (maybe
+        of another process) changes the store"""
+        with self._lock:
+            return self._connection.execute(
+                'PRAGMA data_version').fetchone()[0]
+
+    def body(self, message_id):
+        """Return the (encrypted) body of a message, or None if it was
+        deleted"""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT body FROM messages WHERE id = ?',
+                (message_id,)).fetchone()
+        if row:
+            return str(row[0])
+        return None
+
+    def delete(self, message_id):
+        """Delete a message. Return whether it was stored"""
+        with self._lock:
+            with self._connection:
+                cursor = self._connection.execute(
+                    'DELETE FROM messages WHERE id = ?', (message_id,))
+                return cursor.rowcount > 0
+
+    def count_unread(self):
+        """Return the number of unread messages indexed by the nyms"""
+        with self._lock:
+            cursor = self._connection.execute(
+                'SELECT nym, COUNT(*) FROM messages WHERE unread = 1 '
+                'GROUP BY nym')
+            return dict(cursor.fetchall())
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
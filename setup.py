@@ -24,6 +24,7 @@ setup(
     keywords='nymphemeral ephemeral nymserver GUI client',
     packages=find_packages(),
     install_requires=[
+        'passlib>=1.6.1',
         'pyaxo>=0.4.1',
         'pycrypto>=2.1.0',
         'python-gnupg>=0.3.5',